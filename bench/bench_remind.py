@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Time parsing remind's output into gcalendar events
+
+a rem -s12 -l style dump is made up, and parsed as get_local_calendar does,
+with the timezone registry kept for the whole run, and cleared before each
+event as if every event read its zoneinfo files again.
+"""
+
+import sys, os, time, random, shutil, tempfile
+from cStringIO import StringIO
+from optparse import OptionParser
+
+__version__ = '0.1alpha'
+_zones = ['Europe/London', 'Europe/Paris', 'America/New_York',
+        'Asia/Tokyo', 'Australia/Sydney']
+_words = ['Rehearsal', 'Dentist', 'Gig', 'Lunch', 'Call', 'Meeting',
+        'Train', 'Lesson']
+
+def makedump(rand, count):
+    """ rem -s output with fileinfo lines for count events """
+    lines = []
+    for i in xrange(count):
+        tags = [rand.choice(('gigs', 'teaching', 'home'))]
+        if rand.random() < 0.2:
+            tags.append('TZ=' + rand.choice(_zones))
+        if rand.random() < 0.1:
+            tags.append('TRANSP=TRANSPARENT')
+        if rand.random() < 0.3:
+            start, duration = '*', '*'
+        else:
+            start = str(rand.randrange(8, 22) * 60)
+            duration = str(rand.choice((30, 60, 90, 180)))
+        lines.append('# fileinfo {0} /home/user/.reminders'.format(i + 1))
+        lines.append('2011/{0:02d}/{1:02d} * {2} {3} {4} {5} {6} at ' \
+                'Hall {7}|notes'.format(rand.randint(1, 12),
+                rand.randint(1, 28), ','.join(tags), duration, start,
+                rand.choice(_words), i, rand.randint(1, 9)))
+    return '\n'.join(lines) + '\n'
+
+def parse(gcalendar, dump, fresh):
+    """ events parsed from dump, clearing the registry before each if fresh
+    """
+    events = []
+    for e in gcalendar.remindevents(StringIO(dump)):
+        events.append(e)
+        if fresh:
+            gcalendar.tzregistry.clear()
+    return events
+
+def timeparse(gcalendar, dump, fresh, repeat):
+    best, events = None, None
+    for r in xrange(repeat):
+        start = time.time()
+        events = parse(gcalendar, dump, fresh)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, [(e.uid, e.dtstart, e.dtend, e.timezonename)
+            for e in events]
+
+def execute():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage, version='%prog ' + __version__)
+    parser.add_option('-n', '--events', dest='count', type='int',
+            default=5000, help='number of events to make up [%default]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+            help='runs to take the best of [%default]')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+
+    # gcalendar reads its config, database and command line when imported
+    home = tempfile.mkdtemp(prefix='gsync-bench-')
+    try:
+        os.environ['HOME'] = home
+        config = open(os.path.join(home, '.gsyncrc'), 'w')
+        config.write('\n'.join(['timezone = Europe/London',
+                'remnewlinechar = |', 'remlocation = " at "',
+                'loglevel = warning', '']))
+        config.close()
+        sys.argv[1:] = []
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+                __file__))))
+        import gcalendar
+        dump = makedump(random.Random(options.seed), options.count)
+        results = []
+        for label, fresh in (('registry', False), ('per event', True)):
+            seconds, events = timeparse(gcalendar, dump, fresh,
+                    options.repeat)
+            results.append(events)
+            print '{0:<10} {1} events  {2:.3f}s  {3:.1f}us/event'.format(
+                    label, options.count, seconds,
+                    seconds / options.count * 1e6)
+        same = results[0] == results[1]
+        print 'events {0}'.format(same and 'the same' or 'DIFFER')
+        return not same and 1 or 0
+    finally:
+        shutil.rmtree(home)
+
+if __name__ == '__main__':
+    sys.exit(execute())
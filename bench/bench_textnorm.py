@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Time textnorm against the loops it replaced, on ordinary contact text
+and on long pasted notes, and check they give the same results"""
+
+import sys, os, time, random
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+import textnorm
+
+__version__ = '0.1alpha'
+
+def oldUnEntity(text):
+    """ xml2vcf.unEntity before textnorm """
+    while unichr(195) in text:
+        # get the character after
+        i = text.index(unichr(195))
+        newtext = text[:i] + unichr(ord(text[i+1]) + 64)
+        if len(text) >= i + 2:
+            newtext += text[i+2:]
+        text = newtext
+    return text
+
+def oldXmlStripAndJoin(string, removeNewLines=True):
+    """ xml2vcf.stripAndJoin before textnorm """
+    if removeNewLines:
+        string = string.replace('\n', '').replace('\r', '')
+    while '  ' in string:
+        string = string.replace('  ', ' ').replace('\n ', '\n').strip()
+    return oldUnEntity(string)
+
+def oldVcfStripAndJoin(string, removeNewLines=True):
+    """ vcf2xml.stripAndJoin before textnorm """
+    if removeNewLines:
+        string = string.replace('\n', '').replace('\r', '')
+    while '  ' in string:
+        string = string.replace('  ', ' ').strip()
+    return string
+
+def newXmlStripAndJoin(string, removeNewLines=True):
+    return textnorm.unEntity(textnorm.stripAndJoin(string, removeNewLines,
+            newlineSpaces=True))
+
+def newVcfStripAndJoin(string, removeNewLines=True):
+    return textnorm.stripAndJoin(string, removeNewLines)
+
+def inputs(rand, size):
+    """ (name, list of strings) to time """
+    words = [u'meeting', u'phone', u'London', u'caf\xe9', u'Z\xfcrich',
+            u'call', u'back', u'notes']
+    def pasted(spaces, mojibake):
+        parts = []
+        for i in xrange(size // 8):
+            parts.append(rand.choice(words))
+            parts.append(u' ' * rand.randint(1, spaces))
+            if rand.random() < 0.1:
+                parts.append(u'\r\n')
+            if mojibake and rand.random() < 0.2:
+                # u'\xe9' as utf-8 read as latin-1
+                parts.append(u'\xc3\xa9')
+        return u''.join(parts)
+    short = [u'  {0}  {1} '.format(rand.choice(words), rand.choice(words))
+            for i in xrange(2000)]
+    return [('short fields', short),
+            ('note, single spaces', [pasted(1, False)]),
+            ('note, space runs', [pasted(40, False)]),
+            ('note, indented', [u'\n'.join([u' ' * 64 + rand.choice(words)
+                    for i in xrange(size // 72)])]),
+            ('note, mojibake', [pasted(3, True)])]
+
+def timeit(func, strings, keepNewLines, repeat):
+    best, result = None, None
+    for r in xrange(repeat):
+        start = time.time()
+        result = [func(s, not keepNewLines) for s in strings]
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, result
+
+def execute():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage, version='%prog ' + __version__)
+    parser.add_option('-n', '--size', dest='size', type='int',
+            default=100000, help='characters in each note [%default]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+            help='runs to take the best of [%default]')
+    (options, args) = parser.parse_args()
+
+    rand = random.Random(0)
+    pairs = [('xml2vcf', oldXmlStripAndJoin, newXmlStripAndJoin),
+            ('vcf2xml', oldVcfStripAndJoin, newVcfStripAndJoin)]
+    print '{0:<8} {1:<20} {2:<9} {3:>10} {4:>10} {5:>6}'.format('module',
+            'input', 'newlines', 'old s', 'new s', 'same')
+    failed = 0
+    for name, strings in inputs(rand, options.size):
+        for module, old, new in pairs:
+            for keepNewLines in (False, True):
+                oldtime, oldresult = timeit(old, strings, keepNewLines,
+                        options.repeat)
+                newtime, newresult = timeit(new, strings, keepNewLines,
+                        options.repeat)
+                same = oldresult == newresult
+                failed += not same
+                print '{0:<8} {1:<20} {2:<9} {3:>10.4f} {4:>10.4f} ' \
+                        '{5:>6}'.format(module, name,
+                        keepNewLines and 'kept' or 'removed', oldtime,
+                        newtime, same and 'yes' or 'NO')
+                sys.stdout.flush()
+    return failed and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(execute())
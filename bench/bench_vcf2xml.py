@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Time vcf2xml.toXml per card on a large vcard corpus
+
+cards are read from the given file, or made up. With --compare, another
+copy of vcf2xml.py (e.g. from an older revision) is timed on the same
+cards and its xml checked against the current one.
+"""
+
+import sys, os, time, random, imp
+from optparse import OptionParser
+import vobject
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+import vcf2xml
+
+__version__ = '0.1alpha'
+
+_given = ['Alice', 'Bob', 'Carol', 'David', 'Eve', 'Frank', 'Grace',
+        'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy']
+_family = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson',
+        'Johnson', 'Davies', 'Robinson', 'Wright', 'Thompson', 'Evans']
+_teltypes = ['HOME', 'WORK', 'CELL', 'WORK,FAX', 'HOME,FAX', 'PREF,CELL',
+        'WORK,PAGER', 'CAR', 'OTHER']
+
+def makecard(rand, i):
+    """ vcard text for a made up contact """
+    given, family = rand.choice(_given), rand.choice(_family)
+    lines = ['BEGIN:VCARD', 'VERSION:3.0',
+            'UID:{0:x}'.format(0x10000 + i),
+            'REV:2011-03-0{0}T12:00:00.000Z'.format(rand.randint(1, 9)),
+            'X-GOOGLE-ETAG:Q3w{0:x}'.format(rand.getrandbits(32)),
+            'N:{0}{1};{2};;Dr;'.format(family, i, given),
+            'FN:Dr {0} {1}{2}'.format(given, family, i)]
+    for j in xrange(rand.randint(1, 3)):
+        lines.append('EMAIL;TYPE=INTERNET,{0}:{1}.{2}{3}@example.com'.format(
+                rand.choice(('HOME', 'WORK', 'PREF,HOME')), given.lower(),
+                family.lower(), j))
+    for j in xrange(rand.randint(0, 4)):
+        lines.append('TEL;TYPE={0}:+44 1632 {1:06d}'.format(
+                rand.choice(_teltypes), rand.randint(0, 999999)))
+    if rand.random() < 0.4:
+        lines.append('ORG:Example Ltd;Research')
+        lines.append('TITLE:Engineer')
+        if rand.random() < 0.5:
+            lines.append('ROLE:Builds things')
+    if rand.random() < 0.4:
+        lines.append('ADR;TYPE={0}:;;{1} High Street;London;;N1 9GU;' \
+                'United Kingdom'.format(rand.choice(('HOME', 'WORK')),
+                rand.randint(1, 200)))
+    if rand.random() < 0.3:
+        lines.append('NOTE:Met at a conference\\,  long ago.')
+    lines.append('END:VCARD')
+    return '\r\n'.join(lines) + '\r\n'
+
+def loadcards(filename, count, seed):
+    if filename:
+        data = open(filename, 'rb').read().decode(vcf2xml._encoding)
+    else:
+        rand = random.Random(seed)
+        data = ''.join([makecard(rand, i) for i in xrange(count)])
+    return list(vobject.readComponents(data))
+
+def timeconvert(module, cards, repeat):
+    """ best time of repeat runs converting all cards, and the xml made by
+    the first, in case a converter changes the cards """
+    best, xml = None, None
+    for r in xrange(repeat):
+        start = time.time()
+        entries = [module.toXml(card) for card in cards]
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+        if xml is None:
+            xml = [module.ET.tostring(entry) for entry in entries]
+    return best, xml
+
+def execute():
+    usage = 'usage: %prog [options] [vcard file]'
+    parser = OptionParser(usage=usage, version='%prog ' + __version__)
+    parser.add_option('-n', '--cards', dest='count', type='int',
+            default=20000, help='number of cards to make up [%default]')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+            help='runs to take the best of [%default]')
+    parser.add_option('-c', '--compare', dest='compare', metavar='FILE',
+            help='another vcf2xml.py to time and check against')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=0)
+    (options, args) = parser.parse_args()
+
+    cards = loadcards(args and args[0], options.count, options.seed)
+    modules = [('current', vcf2xml)]
+    if options.compare:
+        modules.append(('compare', imp.load_source('vcf2xml_compare',
+                options.compare)))
+    results = []
+    for label, module in modules:
+        seconds, xml = timeconvert(module, cards, options.repeat)
+        results.append(xml)
+        print '{0:<8} {1} cards  {2:.3f}s  {3:.1f}us/card'.format(label,
+                len(cards), seconds, seconds / len(cards) * 1e6)
+    if len(results) > 1:
+        differ = sum([a != b for a, b in zip(*results)])
+        print 'xml differs for {0} cards'.format(differ)
+        return differ and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(execute())
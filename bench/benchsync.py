@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmark gcontacts.py end to end against the fake Google server
+
+for each address book size a new home directory is made, and each phase of
+a sync is run as its own gcontacts process:
+    initial     empty contacts file, every contact downloaded
+    unchanged   nothing changed since the last sync
+    remote      1% of contacts changed on Google
+    local       1% of contacts changed in the contacts file
+    forced      -f, every contact downloaded and compared
+wall time, requests made to the server and peak RSS are reported for each.
+"""
+
+import sys, os, time, shutil, tempfile, subprocess
+from datetime import datetime, timedelta
+from optparse import OptionParser
+import fakegoogle
+
+__version__ = '0.1alpha'
+_here = os.path.dirname(os.path.abspath(__file__))
+_gcontacts = os.path.join(os.path.dirname(_here), 'gcontacts.py')
+_dtformat = '%Y-%m-%dT%H:%M:%S.%fZ'
+_user = 'bench@example.com'
+_phases = ('initial', 'unchanged', 'remote', 'local', 'forced')
+
+def writeconfig(home, server):
+    """ config file pointing gcontacts at the server """
+    config = open(os.path.join(home, '.gsyncrc'), 'w')
+    config.write('\n'.join([
+            'user = ' + _user,
+            'password = secret',
+            'contacts = ~/contacts.vcf',
+            'defaultresolution = prefer local',
+            'loglevel = warning',
+            'loginurl = {0}/accounts/ClientLogin'.format(server.url()),
+            'contactsurl = {0}/m8/feeds/contacts/'.format(server.url()),
+            '']))
+    config.close()
+
+def editlocal(filename, every=100):
+    """ change one card in every, with a revision time after the last sync
+    return number changed """
+    contactsfile = open(filename, 'rb')
+    cards = contactsfile.read().split('BEGIN:VCARD')
+    contactsfile.close()
+    rev = (datetime.utcnow() + timedelta(seconds=1)).strftime(_dtformat)
+    changed = 0
+    for i in xrange(1, len(cards), every):
+        lines = cards[i].split('\r\n')
+        lines = [l for l in lines if not l.startswith('REV:')]
+        end = lines.index('END:VCARD')
+        lines[end:end] = ['NOTE:edited for benchmark', 'REV:' + rev]
+        cards[i] = '\r\n'.join(lines)
+        changed += 1
+    contactsfile = open(filename, 'wb')
+    contactsfile.write('BEGIN:VCARD'.join(cards))
+    contactsfile.close()
+    return changed
+
+def runsync(home, args=()):
+    """ run gcontacts in home, return (seconds, peak rss in kB, exit status)
+    """
+    env = dict(os.environ)
+    env['HOME'] = home
+    log = open(os.path.join(home, 'gcontacts.log'), 'ab')
+    start = time.time()
+    process = subprocess.Popen([sys.executable, _gcontacts] + list(args),
+            cwd=home, env=env, stdout=log, stderr=log)
+    pid, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    log.close()
+    return seconds, usage.ru_maxrss, status
+
+def bench(size, keep=False):
+    """ run each phase for an address book of size contacts
+    return list of (phase, seconds, stats, peak rss in kB) """
+    home = tempfile.mkdtemp(prefix='gsync-bench-')
+    server = fakegoogle.FakeGoogle()
+    server.store.populate(size)
+    server.start()
+    results = []
+    try:
+        writeconfig(home, server)
+        open(os.path.join(home, 'contacts.vcf'), 'wb').close()
+        for phase in _phases:
+            args = []
+            if phase == 'remote':
+                server.store.touch(max(1, size // 100))
+            elif phase == 'local':
+                editlocal(os.path.join(home, 'contacts.vcf'))
+            elif phase == 'forced':
+                args.append('-f')
+            server.takestats()
+            seconds, rss, status = runsync(home, args)
+            results.append((phase, seconds, server.takestats(), rss))
+            if status != 0:
+                print >>sys.stderr, 'gcontacts failed, see {0}'.format(
+                        os.path.join(home, 'gcontacts.log'))
+                keep = True
+                break
+    finally:
+        server.shutdown()
+        server.server_close()
+        if not keep:
+            shutil.rmtree(home)
+    return results
+
+def execute():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage, version='%prog ' + __version__)
+    parser.add_option('-s', '--sizes', dest='sizes', default='1000,10000,50000',
+            help='comma separated address book sizes [%default]')
+    parser.add_option('-k', '--keep', dest='keep', action='store_true',
+            default=False, help='keep the home directories of each run')
+    (options, args) = parser.parse_args()
+
+    print '{0:>7} {1:<10} {2:>9} {3:>9} {4:>9} {5:>10}'.format('size',
+            'phase', 'seconds', 'requests', 'contacts', 'peak MB')
+    for size in [int(s) for s in options.sizes.split(',')]:
+        for phase, seconds, stats, rss in bench(size, options.keep):
+            # contacts sent or received individually or in batches
+            moved = sum([stats.get(k, 0) for k in ('get', 'update',
+                    'insert', 'batch-entries')])
+            print '{0:>7} {1:<10} {2:>9.2f} {3:>9} {4:>9} {5:>10.1f}'.format(
+                    size, phase, seconds, stats.get('requests', 0), moved,
+                    rss / 1024.0)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    sys.exit(execute())
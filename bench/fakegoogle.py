@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Stand-in for the Google Contacts API, for benchmarks
+
+serves ClientLogin and the contacts of any user from memory: paginated
+feeds with updated-min, single contacts, inserts, updates and deletes sent
+with X-HTTP-Method-Override, etags with 304 and 412 responses, and batch
+feeds. GET /_stats returns request counts as json, /_stats?reset=1 also
+clears them.
+"""
+
+import sys, random, threading, gzip, json, re, urllib, urlparse
+import BaseHTTPServer, SocketServer
+from cStringIO import StringIO
+from datetime import datetime
+from xml.etree import ElementTree as ET
+from optparse import OptionParser
+
+__version__ = '0.1alpha'
+namespaces = {
+        'atom':       'http://www.w3.org/2005/Atom',
+        'gd':         'http://schemas.google.com/g/2005',
+        'gcontact':   'http://schemas.google.com/contact/2008',
+        'batch':      'http://schemas.google.com/gdata/batch',
+        'openSearch': 'http://a9.com/-/spec/opensearch/1.1/' }
+for prefix, uri in namespaces.items():
+    ET.register_namespace(prefix, uri)
+_dtformat = '%Y-%m-%dT%H:%M:%S.%fZ'
+_feedpath = re.compile(r'^/m8/feeds/contacts/([^/]+)/full(?:/([^/]+))?$')
+_idpath = re.compile(r'^/m8/feeds/contacts/([^/]+)/(?:full|base)/([^/]+)$')
+# elements of a posted entry that the server sets itself
+_ignored = ('id', 'updated', 'category', 'link', 'title', 'edited')
+
+def addNS(tag, namespace):
+    """ add a namespace from the namespace dictionary to a tag """
+    return '{{{0}}}{1}'.format(namespaces[namespace], tag)
+
+def splitNS(tag):
+    """ split namespace from element names """
+    if '}' in tag:
+        ns, div, nn = tag.partition('}')
+        return ns[1:], nn
+    return None, tag
+
+def timestamp(dt):
+    """ google's time format, with milliseconds """
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + \
+            '{0:03d}Z'.format(dt.microsecond // 1000)
+
+class Contact():
+    """ a contact's details, etag and update time """
+    def __init__(self, cid, details):
+        self.cid = cid
+        self.details = details
+        self.version = 0
+        self.xml = None
+        self.touch()
+
+    def touch(self, details=None):
+        """ record a change """
+        if details is not None:
+            self.details = details
+        self.version += 1
+        self.updated = datetime.utcnow()
+        self.etag = '"{0}x{1}."'.format(self.cid, self.version)
+        self.xml = None
+
+class Store():
+    """ contacts kept in memory, shared by all users """
+    def __init__(self):
+        self.contacts = {}
+        self.lock = threading.RLock()
+        # changes whenever any contact does, for the feed etag
+        self.version = 0
+        self.nextid = 0
+
+    def _newid(self):
+        self.nextid += 1
+        return '{0:x}'.format(0x10000 + self.nextid)
+
+    def populate(self, n, seed=0):
+        """ add n made up contacts """
+        rand = random.Random(seed)
+        with self.lock:
+            for i in xrange(n):
+                self.add(makedetails(rand, i))
+
+    def add(self, details):
+        with self.lock:
+            contact = Contact(self._newid(), details)
+            self.contacts[contact.cid] = contact
+            self.version += 1
+            return contact
+
+    def update(self, cid, details, etag=None):
+        """ return (status, contact) """
+        with self.lock:
+            contact = self.contacts.get(cid)
+            if contact is None:
+                return 404, None
+            if etag not in (None, '*', contact.etag):
+                return 412, contact
+            contact.touch(details)
+            self.version += 1
+            return 200, contact
+
+    def delete(self, cid, etag=None):
+        with self.lock:
+            contact = self.contacts.get(cid)
+            if contact is None:
+                return 404, None
+            if etag not in (None, '*', contact.etag):
+                return 412, contact
+            del self.contacts[cid]
+            self.version += 1
+            return 200, None
+
+    def touch(self, n, seed=0):
+        """ change n contacts at random, as if edited on google
+        return their ids """
+        rand = random.Random(seed)
+        with self.lock:
+            cids = rand.sample(sorted(self.contacts), min(n,
+                    len(self.contacts)))
+            for cid in cids:
+                contact = self.contacts[cid]
+                details = list(contact.details)
+                details.append(makeelement('phoneNumber', 'gd',
+                        '+44 20 7946 {0:04d}'.format(rand.randint(0, 9999)),
+                        rel=namespaces['gd'] + '#other'))
+                contact.touch(details)
+            self.version += 1
+            return cids
+
+    def listing(self, updatedmin=None):
+        """ contacts in feed order, those updated after updatedmin only if
+        given """
+        with self.lock:
+            contacts = self.contacts.values()
+        if updatedmin is None:
+            return sorted(contacts, key=lambda c: c.cid)
+        contacts = [c for c in contacts if c.updated > updatedmin]
+        return sorted(contacts, key=lambda c: c.updated)
+
+def makeelement(tag, namespace, text=None, **attrib):
+    element = ET.Element(addNS(tag, namespace), attrib)
+    element.text = text
+    return element
+
+_given = ['Alice', 'Bob', 'Carol', 'David', 'Eve', 'Frank', 'Grace',
+        'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy']
+_family = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson',
+        'Johnson', 'Davies', 'Robinson', 'Wright', 'Thompson', 'Evans']
+
+def makedetails(rand, i):
+    """ made up name, emails, phone numbers, organization and address """
+    given, family = rand.choice(_given), rand.choice(_family)
+    details = []
+    name = makeelement('name', 'gd')
+    name.append(makeelement('givenName', 'gd', given))
+    name.append(makeelement('familyName', 'gd', u'{0}{1}'.format(family, i)))
+    name.append(makeelement('fullName', 'gd', u'{0} {1}{2}'.format(given,
+            family, i)))
+    details.append(name)
+    for j in xrange(rand.randint(1, 3)):
+        details.append(makeelement('email', 'gd',
+                address='{0}.{1}{2}.{3}@example.com'.format(given.lower(),
+                family.lower(), i, j), rel=namespaces['gd'] + '#home'))
+    for j in xrange(rand.randint(0, 3)):
+        details.append(makeelement('phoneNumber', 'gd',
+                '+44 1632 {0:06d}'.format(rand.randint(0, 999999)),
+                rel=namespaces['gd'] + rand.choice(('#home', '#work',
+                '#mobile'))))
+    if rand.random() < 0.3:
+        org = makeelement('organization', 'gd',
+                rel=namespaces['gd'] + '#work')
+        org.append(makeelement('orgName', 'gd', 'Example Ltd'))
+        org.append(makeelement('orgTitle', 'gd', 'Engineer'))
+        details.append(org)
+    if rand.random() < 0.3:
+        adr = makeelement('structuredPostalAddress', 'gd',
+                rel=namespaces['gd'] + '#home')
+        adr.append(makeelement('street', 'gd', '{0} High Street'.format(
+                rand.randint(1, 200))))
+        adr.append(makeelement('city', 'gd', 'London'))
+        adr.append(makeelement('postcode', 'gd', 'N1 9GU'))
+        details.append(adr)
+    if rand.random() < 0.2:
+        details.append(makeelement('content', 'atom', 'Met at a conference.',
+                type='text'))
+    return details
+
+def entryelement(contact, user, base):
+    """ atom entry for a contact """
+    entry = ET.Element(addNS('entry', 'atom'))
+    entry.set(addNS('etag', 'gd'), contact.etag)
+    ET.SubElement(entry, addNS('id', 'atom')).text = \
+            'http://www.google.com/m8/feeds/contacts/{0}/base/{1}'.format(
+            urllib.quote(user), contact.cid)
+    ET.SubElement(entry, addNS('updated', 'atom')).text = \
+            timestamp(contact.updated)
+    ET.SubElement(entry, addNS('category', 'atom'),
+            scheme=namespaces['gd'] + '#kind',
+            term=namespaces['gcontact'] + '#contact')
+    ET.SubElement(entry, addNS('link', 'atom'), rel='edit',
+            type='application/atom+xml',
+            href='{0}/m8/feeds/contacts/{1}/full/{2}'.format(base, user,
+            contact.cid))
+    entry.extend(contact.details)
+    return entry
+
+def renderentry(contact, user, base):
+    """ entry xml, kept until the contact changes """
+    if contact.xml is None:
+        contact.xml = ET.tostring(entryelement(contact, user, base),
+                encoding='utf-8')
+    return contact.xml
+
+def parsedetails(entry):
+    """ contact details from a posted entry, and its etag if any """
+    details = []
+    for element in entry:
+        ns, nn = splitNS(element.tag)
+        if ns == namespaces['batch'] or nn in _ignored:
+            continue
+        details.append(element)
+    return details, entry.get(addNS('etag', 'gd'))
+
+def entrycid(entry, user):
+    """ contact id at the end of an entry's id url, or None if there is none
+    or the url is for another user's contacts """
+    element = entry.find(addNS('id', 'atom'))
+    if element is None or not element.text:
+        return None
+    match = _idpath.match(urlparse.urlsplit(element.text.strip()).path)
+    if match is None or urllib.unquote(match.group(1)) != user:
+        return None
+    return match.group(2)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ answers requests from the store of the server """
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeGoogle/' + __version__
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                    *args)
+
+    def count(self, kind, n=1):
+        with self.server.statslock:
+            self.server.stats[kind] = self.server.stats.get(kind, 0) + n
+
+    def base(self):
+        return 'http://' + self.headers.get('host', '{0}:{1}'.format(
+                *self.server.server_address))
+
+    def reply(self, code, body='', contenttype='application/atom+xml; ' \
+            'charset=UTF-8', headers=None):
+        if 'gzip' in self.headers.get('accept-encoding', '') and \
+                len(body) > 512:
+            data = StringIO()
+            gz = gzip.GzipFile(fileobj=data, mode='wb')
+            gz.write(body)
+            gz.close()
+            body = data.getvalue()
+            headers = dict(headers or {})
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(code)
+        if body:
+            self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.count('bytes', len(body))
+
+    def error(self, code, message=''):
+        self.count('error-{0}'.format(code))
+        self.reply(code, message, 'text/plain')
+
+    def readbody(self):
+        length = int(self.headers.get('content-length', 0))
+        return self.rfile.read(length)
+
+    def authorized(self):
+        if self.headers.get('authorization') == \
+                'GoogleLogin auth=' + self.server.token:
+            return True
+        self.error(401, 'Token invalid')
+        return False
+
+    def do_GET(self):
+        self.count('requests')
+        url = urlparse.urlsplit(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path == '/_stats':
+            with self.server.statslock:
+                stats = dict(self.server.stats)
+                if query.get('reset'):
+                    self.server.stats.clear()
+            return self.reply(200, json.dumps(stats), 'application/json')
+        match = _feedpath.match(url.path)
+        if match is None:
+            return self.error(404, 'Not found')
+        if not self.authorized():
+            return
+        user, cid = urllib.unquote(match.group(1)), match.group(2)
+        if cid is None:
+            return self.feed(user, query)
+        contact = self.server.store.contacts.get(cid)
+        if contact is None:
+            return self.error(404, 'Contact not found')
+        if self.headers.get('if-none-match') == contact.etag:
+            self.count('get-304')
+            return self.reply(304)
+        self.count('get')
+        self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>' +
+                renderentry(contact, user, self.base()),
+                headers={'ETag': contact.etag})
+
+    def feed(self, user, query):
+        """ a page of the contacts feed """
+        updatedmin = query.get('updated-min')
+        if updatedmin is not None:
+            updatedmin = datetime.strptime(updatedmin, _dtformat)
+        start = int(query.get('start-index', '1'))
+        maxresults = int(query.get('max-results', '25'))
+        etag = '"feed{0}-{1}-{2}-{3}."'.format(self.server.store.version,
+                updatedmin, start, maxresults)
+        if self.headers.get('if-none-match') == etag:
+            self.count('feed-304')
+            return self.reply(304)
+        self.count('feed')
+        contacts = self.server.store.listing(updatedmin)
+        page = contacts[start - 1:start - 1 + maxresults]
+        base = self.base()
+        feedurl = '{0}/m8/feeds/contacts/{1}/full'.format(base, user)
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+                '<feed xmlns="{atom}" xmlns:openSearch="{openSearch}" ' \
+                'xmlns:gd="{gd}" xmlns:gContact="{gcontact}" ' \
+                'xmlns:batch="{batch}" gd:etag="{0}">'.format(
+                etag.replace('"', '&quot;'), **namespaces),
+                '<id>{0}</id>'.format(user),
+                '<updated>{0}</updated>'.format(timestamp(datetime.utcnow())),
+                '<title>Contacts</title>',
+                '<openSearch:totalResults>{0}</openSearch:totalResults>'.format(
+                len(contacts)),
+                '<openSearch:startIndex>{0}</openSearch:startIndex>'.format(
+                start),
+                '<link rel="self" type="application/atom+xml" ' \
+                'href="{0}"/>'.format(feedurl)]
+        if start - 1 + maxresults < len(contacts):
+            nextquery = dict(query)
+            nextquery['start-index'] = str(start + maxresults)
+            parts.append('<link rel="next" type="application/atom+xml" ' \
+                    'href="{0}"/>'.format(escape(feedurl + '?' +
+                    urllib.urlencode(nextquery))))
+        with self.server.store.lock:
+            parts.extend([renderentry(c, user, base) for c in page])
+        parts.append('</feed>')
+        self.reply(200, ''.join(parts), headers={'ETag': etag})
+
+    def do_POST(self):
+        self.count('requests')
+        url = urlparse.urlsplit(self.path)
+        body = self.readbody()
+        if url.path == '/accounts/ClientLogin':
+            form = dict(urlparse.parse_qsl(body))
+            if not form.get('Email') or not form.get('Passwd'):
+                return self.error(403, 'Error=BadAuthentication')
+            self.count('login')
+            return self.reply(200, 'SID=fake\nLSID=fake\nAuth={0}\n'.format(
+                    self.server.token), 'text/plain')
+        match = _feedpath.match(url.path)
+        if match is None:
+            return self.error(404, 'Not found')
+        if not self.authorized():
+            return
+        user, cid = urllib.unquote(match.group(1)), match.group(2)
+        method = self.headers.get('x-http-method-override', 'POST').upper()
+        if cid == 'batch':
+            return self.batch(user, body)
+        ifmatch = self.headers.get('if-match')
+        if method == 'DELETE':
+            self.count('delete')
+            status, contact = self.server.store.delete(cid, ifmatch)
+            if status != 200:
+                return self.error(status)
+            return self.reply(200)
+        try:
+            entry = ET.fromstring(body)
+        except SyntaxError:
+            return self.error(400, 'Invalid entry')
+        details, etag = parsedetails(entry)
+        if method == 'PUT' and cid is not None:
+            self.count('update')
+            status, contact = self.server.store.update(cid, details,
+                    ifmatch or etag)
+            if status != 200:
+                return self.error(status, 'Etag mismatch' if status == 412
+                        else 'Contact not found')
+        elif method == 'POST' and cid is None:
+            self.count('insert')
+            status, contact = 201, self.server.store.add(details)
+        else:
+            return self.error(405, 'Method not allowed')
+        self.reply(status, '<?xml version="1.0" encoding="UTF-8"?>' +
+                renderentry(contact, user, self.base()),
+                headers={'ETag': contact.etag})
+
+    def batch(self, user, body):
+        """ carry out the operations of a batch feed """
+        self.count('batch')
+        try:
+            feed = ET.fromstring(body)
+        except SyntaxError:
+            return self.error(400, 'Invalid batch feed')
+        store = self.server.store
+        base = self.base()
+        result = ET.Element(addNS('feed', 'atom'))
+        for entry in feed.findall(addNS('entry', 'atom')):
+            self.count('batch-entries')
+            operation = entry.find(addNS('operation', 'batch'))
+            operation = 'insert' if operation is None else \
+                    operation.get('type')
+            batchid = entry.findtext(addNS('id', 'batch'))
+            cid = entrycid(entry, user)
+            details, etag = parsedetails(entry)
+            contact = None
+            if operation == 'insert':
+                status, contact = 201, store.add(details)
+            elif operation == 'update':
+                status, contact = store.update(cid, details, etag)
+            elif operation == 'delete':
+                status, contact = store.delete(cid, etag)
+            elif operation == 'query':
+                contact = store.contacts.get(cid)
+                status = 404 if contact is None else 200
+            else:
+                status = 400
+            if status not in (200, 201):
+                self.count('error-{0}'.format(status))
+                contact = None
+            if contact is not None:
+                with store.lock:
+                    element = entryelement(contact, user, base)
+            else:
+                element = ET.Element(addNS('entry', 'atom'))
+            ET.SubElement(element, addNS('id', 'batch')).text = batchid
+            ET.SubElement(element, addNS('operation', 'batch'),
+                    type=operation)
+            ET.SubElement(element, addNS('status', 'batch'),
+                    code=str(status),
+                    reason=BaseHTTPServer.BaseHTTPRequestHandler.responses.get(
+                    status, ('',))[0])
+            result.append(element)
+        self.reply(200, ET.tostring(result, encoding='utf-8'))
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('"', '&quot;').replace('<',
+            '&lt;')
+
+class FakeGoogle(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ the server, with its store of contacts and request counts """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.store = Store()
+        self.stats = {}
+        self.statslock = threading.Lock()
+        self.verbose = verbose
+        self.newtoken()
+
+    def newtoken(self):
+        """ issue a new auth token, the old one is then rejected """
+        self.token = 'fake{0:x}'.format(random.getrandbits(64))
+
+    def url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    def start(self):
+        """ serve from a background thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def takestats(self):
+        """ request counts since the last call """
+        with self.statslock:
+            stats = dict(self.stats)
+            self.stats.clear()
+        return stats
+
+def execute():
+    usage = 'usage: %prog [options]'
+    parser = OptionParser(usage=usage, version='%prog ' + __version__)
+    parser.add_option('-p', '--port', dest='port', type='int', default=8080,
+            help='port to listen on')
+    parser.add_option('-n', '--contacts', dest='contacts', type='int',
+            default=1000, help='number of made up contacts to start with')
+    parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
+            default=False, help='log requests')
+    (options, args) = parser.parse_args()
+    server = FakeGoogle(('127.0.0.1', options.port), options.verbose)
+    server.store.populate(options.contacts)
+    print >>sys.stderr, 'Serving {0} contacts at {1}'.format(
+            options.contacts, server.url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    sys.exit(execute())
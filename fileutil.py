@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""File helpers shared by the sync tools"""
+
+import os, tempfile
+
+def tempfor(filename):
+    """ open a temporary file in the same directory as filename, so it can
+    be renamed over it, return (file object, temporary file name) """
+    directory, basename = os.path.split(filename)
+    fd, tempname = tempfile.mkstemp(prefix='.' + basename + '.',
+            dir=directory or '.')
+    return os.fdopen(fd, 'wb'), tempname
+
+def replace(tempname, filename, mode=None):
+    """ rename a temporary file over filename, keeping filename's mode """
+    if mode is None and os.path.exists(filename):
+        mode = os.stat(filename).st_mode & 0777
+    if mode is not None:
+        os.chmod(tempname, mode)
+    os.rename(tempname, filename)
+
+def atomicwrite(filename, data, mode=None):
+    """ write data to filename, so it is either replaced entirely or not
+    at all """
+    temp, tempname = tempfor(filename)
+    try:
+        temp.write(data)
+        temp.close()
+        replace(tempname, filename, mode)
+    except:
+        temp.close()
+        os.remove(tempname)
+        raise
@@ -2,12 +2,12 @@
 # -*- coding: UTF-8 -*-
 """Synchronize google calendar"""
 
-import os.path
+import os.path, time
 import codecs, locale
-import shelve, logging
+import statestore, tokencache, logging, threading, Queue
 import subprocess, hashlib
+import transport, scheduler, tzregistry
 from datetime import date, datetime, timedelta
-from dateutil.tz import tzlocal, tzfile
 from dateutil import parser as dtparser
 from configobj import ConfigObj
 from optparse import OptionParser
@@ -25,7 +25,9 @@ _ddformat = '%Y-%m-%d'
 _remformat = '%d %b %Y'
 # note convolutions to get colon in timezone offset
 options = ConfigObj(os.path.expanduser('~/.gsyncrc'))
-caldb = shelve.open(os.path.expanduser('~/.gcaldb'), writeback=True)
+caldb = statestore.open(os.path.expanduser('~/.gcaldb'),
+        tables=('remotedb', 'calendars'),
+        backend=options.get('statebackend', 'sqlite'))
 # parse command line options
 usage = 'usage: %prog [options]'
 parser = OptionParser(usage=usage, version='%prog ' + __version__)
@@ -62,14 +64,12 @@ class Event():
         self.uid = hashlib.md5(remline.encode(_encoding)).hexdigest()
         fields = remline.split(None, 5)
         # set defaults
-        tzfilename = '/usr/share/zoneinfo/' + options['timezone']
-        if os.path.isfile(tzfilename):
-            self.timezone = tzfile(tzfilename)
-            self.timezonename = options['timezone']
-        else:
-            logger.debug('No timezone file {0}. ' + \
+        self.timezone = tzregistry.get(options['timezone'])
+        self.timezonename = options['timezone']
+        if self.timezone is None:
+            logger.debug('No timezone file {0}. ' \
                     'Setting to local zone.'.format(options['timezone']))
-            self.timezone = tzlocal()
+            self.timezone = tzregistry.local()
             self.timezonename = 'localtime'
         self.transp = 'OPAQUE'
         self.categories = []
@@ -93,9 +93,9 @@ class Event():
             if '=' in t:
                 (k, v) = t.split('=')
                 if k == 'TZ':
-                    tzfilename = '/usr/share/zoneinfo/' + v
-                    if os.path.isfile(tzfilename):
-                        self.timezone = tzfile(tzfilename)
+                    timezone = tzregistry.get(v)
+                    if timezone is not None:
+                        self.timezone = timezone
                         self.timezonename = v
                     else:
                         logger.error('No timezone file {0}'.format(v))
@@ -180,16 +180,17 @@ class Remevent():
                 gevent.title.text))
             self.ignore = True
             return
+        localzone = tzregistry.local()
         if start.tzinfo:
-            start = start.astimezone(tzlocal())
+            start = start.astimezone(localzone)
         else:
-            start = start.replace(tzinfo=tzlocal())
+            start = start.replace(tzinfo=localzone)
         # end time
         end = dtparser.parse(gevent.when[0].end_time)
         if end.tzinfo:
-            end = end.astimezone(tzlocal())
+            end = end.astimezone(localzone)
         else:
-            end = end.replace(tzinfo=tzlocal())
+            end = end.replace(tzinfo=localzone)
         # remdict is for file format
         remdict = {'date': start.strftime(remdateformat),
                 'time': '', 'dur': '', 'tag': '',
@@ -202,8 +203,9 @@ class Remevent():
             remdict['time'] = ' AT ' + start.strftime(remtimeformat)
             remsdict['time'] = (start.time().hour * 60) + \
                     start.time().minute
-        # calculate duration
-        dur = end - start
+        # calculate duration, in utc as times in the same zone object are
+        # subtracted without their offsets
+        dur = end.astimezone(tzregistry.utc) - start.astimezone(tzregistry.utc)
         if dur and dur.days != 1:
             durminutes = ((dur.days * 24 * 3600) + dur.seconds) / 60
             duration = '{0[0]}:{0[1]:02}'.format(divmod(durminutes, 60))
@@ -302,14 +304,42 @@ if runoptions.verbose:
     logger = make_logger(logging.DEBUG)
 else:
     logger = make_logger(logging._levelNames[options['loglevel'].upper()])
+transport.configure(options, logger)
+
+def requeststatus(error):
+    """ status and Retry-After of a failed gdata request, for the scheduler """
+    if isinstance(error, gdata.service.RequestError):
+        return error[0]['status'], scheduler.parseretryafter(
+                transport.lastretryafter())
+    return None
+
+# bulk and retried calls to google go through this
+googlecalls = scheduler.fromoptions(options, requeststatus, logger)
 
 def authenticate():
-    """attempt to authenticate user"""
+    """attempt to authenticate user, using the cached token if it has not
+    expired"""
     service = gdata.calendar.service.CalendarService()
     service.email = options['user']
     service.password = options['password']
     service.source = __scriptname__
-    service.ProgrammaticLogin()
+    tokens = tokencache.fromoptions(options)
+    def login():
+        service.ProgrammaticLogin()
+        tokens.set(options['user'], 'cl', service.GetClientLoginToken())
+    def reauth():
+        logger.info(u'Authentication token expired, logging in again.')
+        tokens.invalidate(options['user'], 'cl')
+        login()
+        return 'GoogleLogin auth=' + service.GetClientLoginToken()
+    # reuse keep-alive connections instead of one per request
+    service.http_client = transport.GDataHttpClient(reauth)
+    token = tokens.get(options['user'], 'cl')
+    if token is not None:
+        logger.debug(u'Using cached authentication token.')
+        service.SetClientLoginToken(token)
+    else:
+        login()
     return service
 
 def get_calendars(service, allcals=False):
@@ -345,21 +375,19 @@ def new_calendar(service, title, colour='#6e6e41'):
     cal.color = gdata.calendar.Color(value=colour)
     cal.timezone = gdata.calendar.Timezone(value='Europe/London')
     cal.where = gdata.calendar.Where(value_string='London')
-    # this sometimes fails, if so try again a few times
-    for i in xrange(5):
-        try:
-            calnew = service.InsertCalendar(new_calendar=cal)
-        except RequestError, msg:
-            pass
-        else:
-            break
-        raise RequestError, msg
+    # this sometimes fails, if so try again a few times, but only when
+    # google says it did not make the calendar
+    calnew = googlecalls.callretrying(scheduler.NOTAPPLIED,
+            service.InsertCalendar, new_calendar=cal)
     return calnew.id.text.rpartition('/')[2].replace('%40', '@')
 
 def get_events(service, calid='default', start=None, end=None,
-        updatedmin=None, maxresults=1000, query=None):
-    """get all events between start and end dates
-    start and end should be datetime.date objects"""
+        updatedmin=None, maxresults=None, query=None):
+    """generate all events between start and end dates
+    start and end should be datetime.date objects. Events are requested
+    maxresults at a time, following each page's next link"""
+    if maxresults is None:
+        maxresults = int(options.get('eventpagesize', '250'))
     evquery = gdata.calendar.service.CalendarEventQuery(calid, 'private',
             'full', query)
     evquery.max_results = maxresults
@@ -371,40 +399,126 @@ def get_events(service, calid='default', start=None, end=None,
         evquery.start_min = start.strftime(_ddformat)
     if end:
         evquery.start_max = end.strftime(_ddformat)
-    evfeed = service.CalendarQuery(evquery)
-    return evfeed
+    evfeed = googlecalls.call(service.CalendarQuery, evquery)
+    while True:
+        for e in evfeed.entry:
+            yield e
+        nextlink = evfeed.GetNextLink()
+        if nextlink is None:
+            break
+        evfeed = googlecalls.call(service.GetCalendarEventFeed,
+                nextlink.href)
 
 def get_all_events(service, updatedmin=None):
+    """generate events of the calendars to sync
+    calendars are fetched from a few threads at once, and their events
+    generated as they arrive"""
     logger.debug(u'Retrieving calendar list.')
     cals = get_calendars(service)
     logger.debug(u'Retrieving event list.')
-    events = []
+    calids = Queue.Queue()
+    count = 0
     for calname, calid in caldb['calendars'].items():
         if 'synconly' in options:
             if calname not in options['synconly']:
                 continue
-        evfeed = get_events(service, calid, updatedmin=updatedmin)
-        events += evfeed.entry
+        calids.put(calid)
+        count += 1
+    # (event, None), then (None, None) when a calendar is done or
+    # (None, error) if it failed; bounded so a slow reader holds up fetching
+    arrived = Queue.Queue(1000)
+    def fetch():
+        while True:
+            try:
+                calid = calids.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                for e in get_events(service, calid, updatedmin=updatedmin):
+                    arrived.put((e, None))
+            except Exception, error:
+                arrived.put((None, error))
+            else:
+                arrived.put((None, None))
+    for i in xrange(min(googlecalls.workers, count)):
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
     # store xml for reference
-    if options['loglevel'] == 'debug' and len(events):
-        logger.debug(u'Saving Google event xml.')
-        savexml(events)
-    return events
-
-def savexml(eventlist):
-    import xml.dom.minidom
-    eventxml = ''
-    for e in eventlist:
-        eventxml += xml.dom.minidom.parseString(str(e)).toprettyxml()
-    xmlfilename = 'google-calendar-{0}.xml'.format(datetime.now().strftime(_dtformat))
-    xmlfile = codecs.open(xmlfilename, 'w', _encoding)
-    xmlfile.write(eventxml)
-    xmlfile.close()
+    saver = None
+    if options['loglevel'] == 'debug':
+        saver = XmlSaver()
+    try:
+        while count:
+            try:
+                # a timeout lets KeyboardInterrupt through
+                e, error = arrived.get(True, 1)
+            except Queue.Empty:
+                continue
+            if e is None:
+                if error is not None:
+                    raise error
+                count -= 1
+                continue
+            if saver is not None:
+                saver.write(e)
+            yield e
+    finally:
+        if saver is not None:
+            saver.close()
+
+class XmlSaver():
+    """ save the xml of events to a file as they arrive """
+    def __init__(self):
+        self.xmlfile = None
+
+    def write(self, event):
+        import xml.dom.minidom
+        if self.xmlfile is None:
+            logger.debug(u'Saving Google event xml.')
+            xmlfilename = 'google-calendar-{0}.xml'.format(
+                    datetime.now().strftime(_dtformat))
+            self.xmlfile = codecs.open(xmlfilename, 'w', _encoding)
+        self.xmlfile.write(xml.dom.minidom.parseString(str(event))
+                .toprettyxml())
+
+    def close(self):
+        if self.xmlfile is not None:
+            self.xmlfile.close()
+
+def filestats(filenames):
+    """ dict of filename: (mtime, size), or None if it does not exist """
+    stats = {}
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            stats[filename] = None
+        else:
+            stats[filename] = (st.st_mtime, st.st_size)
+    return stats
+
+def remindevents(lines):
+    """ generate events from lines of rem -s -l output, each event line
+    following a fileinfo line """
+    fileinfo = None
+    for line in lines:
+        line = line.decode(_encoding)
+        if not line.strip():
+            continue
+        if line.startswith(u'# fileinfo '):
+            fileinfo = line[len(u'# fileinfo '):]
+        elif fileinfo is None:
+            logger.error(u'Remind line without fileinfo:\n{0}'.format(line))
+        else:
+            yield Event(fileinfo + line)
+            fileinfo = None
 
 def get_local_calendar():
-    """ get local calendar, return dict of (hash, event) """
+    """ get local calendar, return dict of (hash, event)
+    the events of the last run are used again if none of remind's files
+    have changed and the same dates are asked for """
     # get events from remind
-    logger.debug(u'Getting events from remind.')
     # remind options:
     #   -s12    simple output, 12 months
     #   -b2     no times
@@ -414,18 +528,37 @@ def get_local_calendar():
     # set date as 90 days ago (TODO: this should be configurable)
     args.extend(datetime.strftime(datetime.utcnow() - timedelta(days=90),
         _remformat).split())
+    # remind reads this file when not given one
+    mainfile = os.path.expanduser(os.environ.get('DOTREMINDERS',
+            '~/.reminders'))
+    settings = (args, mainfile, options.get('timezone'),
+            options.get('remnewlinechar'), options.get('remlocation'))
+    cache = caldb.get('remindcache')
+    if cache is not None and cache['settings'] == settings and \
+            cache['files'] == filestats(cache['files'].keys()):
+        logger.debug(u'Remind files unchanged, using events of last run.')
+        return cache['events']
+    logger.debug(u'Getting events from remind.')
+    started = time.time()
     rem = subprocess.Popen(args, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, close_fds=True).communicate()
-    # TODO: close process?
-    if rem[1] != '':
-        print rem
+            stderr=subprocess.PIPE, close_fds=True)
+    # read errors at the same time, so remind cannot block writing them
+    errors = []
+    drain = threading.Thread(target=lambda: errors.append(rem.stderr.read()))
+    drain.daemon = True
+    drain.start()
+    logger.debug(u'Parsing calendar.')
+    try:
+        localcalendar = dict((e.uid, e)
+                for e in remindevents(iter(rem.stdout.readline, '')))
+    finally:
+        rem.stdout.close()
+        rem.wait()
+        drain.join()
+    if errors[0] != '':
+        print errors[0]
         logger.error(u'Call to remind failed.')
         return dict()
-    remlines = rem[0].lstrip('# fileinfo ').split('\n# fileinfo ')
-    events = []
-    logger.debug(u'Parsing calendar.')
-    for r in remlines:
-        events.append(Event(r.decode(_encoding)))
 
     # check if event is in range
     #evstart = parsedatestring('%s%s%s' % (year, month, day))
@@ -437,8 +570,15 @@ def get_local_calendar():
     #    if evstart > options.to:
     #        continue
 
-    # parse into dictionary of calendar
-    localcalendar = dict([(e.uid, e) for e in events])
+    # keep for the next run, unless a file is missing or was changed while
+    # remind was reading it
+    files = filestats(set([mainfile] +
+            [e.filename for e in localcalendar.values()]))
+    if None not in files.values() and \
+            max([mtime for mtime, size in files.values()]) < started:
+        caldb['remindcache'] = {'settings': settings, 'files': files,
+                'events': localcalendar}
+        caldb.sync()
     return localcalendar
 
 def askdelete(event, dbevent):
@@ -458,8 +598,9 @@ def detect_remote_changes(service, events):
     deleted = []
     unchanged, notindb = 0, 0
     updatedtimes = {}
-    logger.info(u'{0} events from Google calendars.'.format(len(events)))
+    count = 0
     for e in events:
+        count += 1
         rem = Remevent(e)
         if rem.ignore:
             continue
@@ -513,6 +654,7 @@ def detect_remote_changes(service, events):
             caldb['remotedb'][rem.remuid] = (rem.remline, rem.filename,
                     rem.linenumber, e.GetEditLink().href)
     caldb.sync()
+    logger.info(u'{0} events from Google calendars.'.format(count))
     logger.info(u'{0} new events from Google calendars.'.format(len(new)))
     logger.info(u'{0} changed events from Google calendars.'.format(
             len(changed)))
@@ -539,7 +681,8 @@ def delete_local(remline, fn, ln, link):
     print remline
 
 def delete_remote(service, link):
-    """ delete event given google link """
+    """ delete event given google link
+    raise gdata.service.RequestError if it fails """
     redirected = 0
     while True:
         try:
@@ -564,14 +707,19 @@ def delete_remote(service, link):
                         link = l.href
                 logger.debug(u'Trying updated link {0}'.format(link))
                 redirected += 1
-            else:
-                logger.error(u'...deletion of link:\n\t{0}\nfailed: {1}'.format(link, msg))
+            elif msg[0]['status'] in (404, 410):
+                logger.debug(u'Link {0} already deleted.'.format(link))
                 break
+            else:
+                raise
         else:
             break
 
 def delete_remote_list(service, uids):
-    """ delete list of events """
+    """ delete list of events
+    deletions are sent from the scheduler's threads, the db is updated here
+    as each one finishes """
+    links = {}
     for uid in uids:
         link = caldb['remotedb'][uid][3]
         remmsg = caldb['remotedb'][uid][0].partition('MSG')[2].strip()
@@ -583,10 +731,16 @@ def delete_remote_list(service, uids):
                 remmsg = ctrl.sub("", remmsg).strip(" %")
         else:
             remmsg = uid
-        logger.debug(u'Deleting "{0}" from Google.'.format(
-                remmsg.decode(_encoding)))
-        delete_remote(service, link)
-        del caldb['remotedb'][uid]
+        links[uid] = (link, remmsg.decode(_encoding))
+    def delete(uid):
+        delete_remote(service, links[uid][0])
+    for uid, result, error in googlecalls.map(delete, links.keys()):
+        if error is None:
+            logger.debug(u'Deleted "{0}" from Google.'.format(links[uid][1]))
+            del caldb['remotedb'][uid]
+        else:
+            logger.error(u'...deletion of "{0}" failed: {1}'.format(
+                    links[uid][1], error))
 
 def delete_all_remote(onlycalname='all'):
     """ delete all remote events """
@@ -600,14 +754,24 @@ def delete_all_remote(onlycalname='all'):
             logger.debug(u'Not deleting events from {0}.'.format(calname))
             continue
         logger.debug(u'Retrieving event list for {0}.'.format(calname))
-        evfeed = get_events(service, calid)
+        # all pages first, deleting would move events between pages
+        links = [e.GetEditLink().href for e in get_events(service, calid)]
         logger.debug(u'Deleting all events from {0}.'.format(calname))
-        for e in evfeed.entry:
-            link = e.GetEditLink().href
-            delete_remote(service, link)
+        for link, result, error in googlecalls.map(
+                lambda link: delete_remote(service, link), links):
+            if error is not None:
+                logger.error(u'...deletion of link:\n\t{0}\nfailed: ' \
+                        '{1}'.format(link, error))
+
+def event_category(event):
+    """ category of an event, which names its calendar, or None """
+    if len(event.categories):
+        return event.categories[0].capitalize()
+    return None
 
-def add_event(service, event):
-    """ add a single event """
+def add_event(service, event, cal='default'):
+    """ add a single event to calendar id cal
+    raise gdata.service.RequestError if it fails """
     gevent = gdata.calendar.CalendarEventEntry()
     gevent.title = atom.Title(text=event.summary)
     if event.location:
@@ -631,18 +795,6 @@ def add_event(service, event):
     tzn = gdata.ExtendedProperty('timezonename', event.timezonename)
     gevent.extended_property.extend([fn, ln, uid, tzn])
 
-    # uri comes from event.categories.value[0]
-    #   =>  split categories into different calendars
-    cal = 'default'
-    if len(event.categories):
-        cat = event.categories[0].capitalize()
-        if cat in caldb['calendars']:
-            cal = caldb['calendars'][cat]
-        else:
-            # add calendar for new categories
-            cal = new_calendar(service, cat)
-            caldb['calendars'][cat] = cal
-            caldb.sync()
     uri = '/calendar/feeds/{0}/private/full'.format(cal)
     redirected = False
     while True:
@@ -657,28 +809,52 @@ def add_event(service, event):
                     redirected = True
                 except:
                     logger.debug(u'Could not extract redirection link.')
-                    break
+                    raise msg
             else:
-                logger.error(u'...adding event failed: {0}'.format(msg))
-                return gevent, False
+                raise
         else:
             break
 
     logger.debug(u'New event "{0}" added.'.format(event.summary[0:40]))
-    return new_event, True
+    return new_event
 
 def add_events(service, uids, events):
-    """ add list of events """
-    for uid in uids:
+    """ add list of events
+    calendars for new categories are made first, one at a time; the events
+    are then sent from the scheduler's threads and added to the db here as
+    each one finishes """
+    # uri comes from event.categories.value[0]
+    #   =>  split categories into different calendars
+    calendars = dict(caldb['calendars'].items())
+    for cat in set([event_category(events[uid]) for uid in uids]):
+        if cat is None or cat in calendars:
+            continue
+        # add calendar for new categories
+        try:
+            calendars[cat] = caldb['calendars'][cat] = new_calendar(service,
+                    cat)
+        except gdata.service.RequestError, msg:
+            logger.error(u'Making calendar {0} failed: {1}'.format(cat, msg))
+    calendars[None] = 'default'
+    adding = [uid for uid in uids if event_category(events[uid]) in calendars]
+    def add(uid):
+        return add_event(service, events[uid],
+                calendars[event_category(events[uid])])
+    # retried only if google did not add the event, or it would be added twice
+    for uid, new_gevent, error in googlecalls.map(add, adding,
+            scheduler.NOTAPPLIED):
         event = events[uid]
-        new_gevent, success = add_event(service, event)
-        if success:
+        if error is None:
             # add event details to db
             remevent = Remevent(new_gevent)
             caldb['remotedb'][uid] = (remevent.remline, event.filename,
                     event.linenumber, remevent.link)
         else:
-            logger.error(u'Adding event failed.')
+            logger.error(u'...adding event "{0}" failed: {1}'.format(
+                    event.summary[0:40], error))
+    for uid in set(uids) - set(adding):
+        logger.error(u'Adding event "{0}" failed: no calendar.'.format(
+                events[uid].summary[0:40]))
 
 def reset():
     """ reset database and delete all remote events """
@@ -701,7 +877,8 @@ def execute():
     # compare to database
     if 'remotedb' not in caldb:
         caldb['remotedb'] = {}
-    new, changed, deleted = detect_remote_changes(service, remoteevents)
+    with caldb.transaction():
+        new, changed, deleted = detect_remote_changes(service, remoteevents)
     # deal with changes
     for e in new:
         e.add_local()
@@ -715,10 +892,11 @@ def execute():
     localevents = get_local_calendar()
     new, deleted = detect_local_changes(localevents)
     # delete remote
-    delete_remote_list(service, deleted)
-    caldb.sync()
+    with caldb.transaction():
+        delete_remote_list(service, deleted)
     # add new events
-    add_events(service, new, localevents)
+    with caldb.transaction():
+        add_events(service, new, localevents)
     # set last sync time in config: now() or utcnow()?
     logger.debug(u'Recording sync details.')
     caldb['lastsync'] = datetime.strftime(datetime.utcnow(), _qdtformat)
@@ -2,11 +2,11 @@
 # -*- coding: UTF-8 -*-
 """Synchronize google contacts"""
 
-import sys, os.path, shutil
-import urllib, urllib2
-import xml2vcf, vcf2xml
-import vobject, codecs, locale
-import shelve, logging
+import sys, os.path, hashlib
+import urllib
+import transport, scheduler, snapshots, vcardindex, xml2vcf, vcf2xml
+import locale
+import statestore, tokencache, logging, threading, multiprocessing
 from datetime import datetime
 from configobj import ConfigObj
 from optparse import OptionParser
@@ -15,9 +15,20 @@ __scriptname__ = 'Contacts-Sync'
 __version__ = '0.1alpha'
 _encoding = locale.getpreferredencoding()
 _dtformat = '%Y-%m-%dT%H:%M:%S.%fZ'
+# fields ignored when comparing contacts, they change on every update, or
+# (VERSION) are only added when a card is written
+_volatile = (u'REV', u'X-GOOGLE-ETAG', u'VERSION')
+# returned instead of a contact that has not changed on google
+NOTMODIFIED = 'not modified'
 options = ConfigObj(os.path.expanduser('~/.gsyncrc'))
-contactdb = shelve.open(os.path.expanduser('~/.gcontactsdb'), writeback=True)
-# TODO: if writeback is detrimental to performance, try to workaround
+contactdb = statestore.open(os.path.expanduser('~/.gcontactsdb'),
+        tables=('fingerprints',), backend=options.get('statebackend', 'sqlite'))
+tokens = tokencache.fromoptions(options)
+# google addresses, which can be pointed at a stand-in server for testing
+_loginurl = options.get('loginurl',
+        'https://www.google.com/accounts/ClientLogin')
+_contactsurl = options.get('contactsurl',
+        'https://www.google.com/m8/feeds/contacts/')
 # parse command line options
 usage = 'usage: %prog [options]'
 parser = OptionParser(usage=usage, version='%prog ' + __version__)
@@ -32,6 +43,12 @@ parser.add_option('-l', '--local', dest='preferlocal', action='store_true',
         default=None)
 parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
         help='print what\'s happening (loglevel = debug)')
+parser.add_option('-s', '--snapshots', dest='listsnapshots',
+        action='store_true', help='list snapshots of the contacts file',
+        default=False)
+parser.add_option('--restore', dest='restore', metavar='TIMESTAMP',
+        help='restore the newest snapshot of the contacts file whose ' +
+        'timestamp starts with TIMESTAMP', default=None)
 (runoptions, args) = parser.parse_args()
 
 # set logging
@@ -56,21 +73,30 @@ if runoptions.verbose:
     logger = makelogger(logging.DEBUG)
 else:
     logger = makelogger(logging._levelNames[options['loglevel'].upper()])
+transport.configure(options, logger)
+# bulk and retried calls to google go through this
+googlecalls = scheduler.fromoptions(options, log=logger)
 
-def authenticate(user, passwd):
-    """attempt to authenticate user"""
+def authenticate(user, passwd, refresh=False):
+    """attempt to authenticate user, using the cached token unless it has
+    expired or refresh is set"""
     def failed(msg):
         logger.critical(u'Authentication failed: ' + msg)
         sys.exit(2)
+    if not refresh:
+        auth = tokens.get(user, 'cp')
+        if auth is not None:
+            logger.debug(u'Using cached authentication token.')
+            return auth
     data = {'Email': user, 'Passwd': passwd, 'accountType': 'GOOGLE',
             'source': __scriptname__, 'service': 'cp'}
     datastring = urllib.urlencode(data)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     try:
-        gdata = urllib2.urlopen('https://www.google.com/accounts/ClientLogin',
-                datastring)
-    except urllib2.HTTPError, msg:
-        failed(msg)
-    gdatatext = gdata.readlines()
+        gdata = transport.urlopen('POST', _loginurl, datastring, headers)
+    except transport.HTTPError, msg:
+        failed(str(msg))
+    gdatatext = gdata.read().splitlines()
     gdata.close()
     try:
         auth = gdatatext[2]
@@ -79,10 +105,57 @@ def authenticate(user, passwd):
     if auth[0:5] != 'Auth=':
         failed('unexpected response')
     # change first 'A' to 'a'
-    return 'a' + auth[1:].strip()
+    auth = 'a' + auth[1:].strip()
+    tokens.set(user, 'cp', auth)
+    return auth
+
+# tokens that replaced expired ones during this run
+_renewed = {}
+_renewlock = threading.Lock()
+
+def renew(auth, used):
+    """ log in again after google rejected token used, which was issued for
+    auth; requests for auth use the new token from now on """
+    with _renewlock:
+        if _renewed.get(auth, auth) != used:
+            # another thread has already renewed it
+            return
+        logger.info(u'Authentication token expired, logging in again.')
+        tokens.invalidate(options['user'], 'cp')
+        _renewed[auth] = authenticate(options['user'], options['password'],
+                refresh=True)
+
+def gdataopen(method, url, auth, body=None, headers=None, cachedir=None):
+    """ send a request to google contacts, raise HTTPError for errors
+    if the token has expired, log in again and send it once more
+    with cachedir, GET url through the cache """
+    for retry in (False, True):
+        used = _renewed.get(auth, auth)
+        sendheaders = dict(headers or {})
+        sendheaders['Authorization'] = 'GoogleLogin ' + used
+        sendheaders['GData-Version'] = '3.0'
+        try:
+            if cachedir is not None:
+                return transport.cachedopen(url, sendheaders, cachedir)
+            return transport.urlopen(method, url, body, sendheaders)
+        except transport.HTTPError, msg:
+            if msg.code != 401 or retry:
+                raise
+            renew(auth, used)
+
+def getcontacts(user, auth, contactid=None, data=None, url=None):
+    """download contacts from google, return unicode xml"""
+    try:
+        gcontactsconn = opencontacts(user, auth, contactid, data, url)
+    except transport.HTTPError, msg:
+        handleconnectionerror(msg)
+        return None
+    return readresponse(gcontactsconn)
 
-def getcontacts(user, auth, contactid=None, data=None):
-    """download contacts from google
+def opencontacts(user, auth, contactid=None, data=None, url=None, etag=None,
+        cache=False):
+    """request contacts from google, return the response to read xml from,
+    raise HTTPError for errors
         use data dictionary for:
           - updated-min
           - max-results
@@ -93,43 +166,101 @@ def getcontacts(user, auth, contactid=None, data=None):
           - sortorder
           - group
         http://code.google.com/apis/contacts/docs/3.0/reference.html#Parameters
+        or give a complete url, e.g. a feed's next link
+        if etag is given, the response has status 304 if it is still current
+        if cache is True, the cached copy is used if it is still current
     """
-    # construct header
-    headers = {'Authorization': 'GoogleLogin ' + auth,
-            'GData-Version': '3.0'}
-    url = 'http://www.google.com/m8/feeds/contacts/' + user + '/full'
-    if contactid:
+    headers = {}
+    if url is not None:
+        # complete url given, use as is
+        pass
+    elif contactid:
         # add contact UID (end of id url) to url to specify single contact
         # http://code.google.com/apis/contacts/docs/3.0/developers_guide_protocol.html
         #   #retrieving_single_contact
-        url += '/' + contactid
-    elif data:
-        # can't send data as POST, append to url
-        url += '?' + urllib.urlencode(data)
-    gcontactsrequest = urllib2.Request(url, None, headers)
-    try:
-        # Error 404: Not Found if contact has been deleted
-        gcontactsconn = urllib2.urlopen(gcontactsrequest)
-    except urllib2.HTTPError, msg:
-        handleconnectionerror(msg)
-        return None
-    # convert to unicode
+        url = _contactsurl + user + '/full/' + contactid
+    else:
+        url = _contactsurl + user + '/full'
+        if data:
+            # can't send data as POST, append to url
+            url += '?' + urllib.urlencode(data)
+    if etag is not None:
+        headers['If-None-Match'] = etag
+    # Error 404: Not Found if contact has been deleted
+    if cache:
+        return gdataopen('GET', url, auth, headers=headers,
+                cachedir=os.path.expanduser(
+                options.get('cachedir', '~/.gsynccache')))
+    return gdataopen('GET', url, auth, headers=headers)
+
+def readresponse(gcontactsconn):
+    """ read a response from google and convert it to unicode """
     gencoding = _encoding
-    for h in gcontactsconn.headers['content-type'].split(';'):
+    for h in gcontactsconn.getheader('content-type', '').split(';'):
         if 'charset' in h:
             gencoding = h.split('=')[1]
     gcontacts = gcontactsconn.read()
     gcontactsconn.close()
     return unicode(gcontacts, gencoding)
 
+def getcontactfeed(user, auth, data=None):
+    """download contacts from google a page at a time, following the feed's
+    next links, and yield the vcards as they are parsed from the response
+    page size is set by 'pagesize' in the config file; a page that cannot
+    be retrieved after the scheduler's retries raises its HTTPError, so the
+    sync stops before recording it is complete"""
+    data = dict(data or {})
+    data['max-results'] = options.get('pagesize', '500')
+    # complete feeds are requested again on every forced sync, so keep them
+    cache = 'updated-min' not in data
+    url = None
+    page = 0
+    while True:
+        gcontactsconn = googlecalls.call(opencontacts, user, auth, data=data,
+                url=url, cache=cache)
+        page += 1
+        logger.debug(u'Receiving page {0} of contact list.'.format(page))
+        stream = gcontactsconn
+        # store xml for reference
+        if options['loglevel'] == 'debug':
+            stream = XmlSaver(gcontactsconn, page)
+        links = {}
+        for vcard in xml2vcf.iterXml(stream, links):
+            yield vcard
+        stream.close()
+        if 'next' not in links:
+            return
+        url = links['next']
+
+def fetchcontact(auth, cuid, etag=None):
+    """ download and parse a single contact, return None if not found
+    if etag is given and the contact still has it, return NOTMODIFIED """
+    if etag is not None:
+        etag = '"{0}."'.format(etag)
+    try:
+        gcontactsconn = opencontacts(options['user'], auth, cuid, etag=etag)
+    except transport.HTTPError, msg:
+        if msg.code != 404:
+            raise
+        handleconnectionerror(msg)
+        return None
+    if gcontactsconn.status == 304:
+        gcontactsconn.close()
+        return NOTMODIFIED
+    return xml2vcf.readXml(readresponse(gcontactsconn))[0]
+
+def getetag(vcard):
+    """ google etag stored in a vcard, or None """
+    if 'x-google-etag' in vcard.contents:
+        return vcard.contents['x-google-etag'][0].value
+    return None
+
 def sendcontact(user, auth, contactxml, contactid=None, delete=False):
     """send new or edited contact to google, or delete existing"""
     # construct header
     # TODO: replace X-HTTP-Method-Override header with proper request from httplib
     #       'X-HTTP-Method-Override': 'POST',
-    headers = {'Authorization': 'GoogleLogin ' + auth,
-            'Content-Type': 'application/atom+xml',
-            'GData-Version': '3.0'}
+    headers = {'Content-Type': 'application/atom+xml'}
     if delete:
         # TODO: not sure if deletion is working yet.
         if not contactid:
@@ -138,55 +269,150 @@ def sendcontact(user, auth, contactxml, contactid=None, delete=False):
         headers['X-HTTP-Method-Override'] = 'DELETE'
         del headers['Content-Type']
         contactxml = None
-    url = 'http://www.google.com/m8/feeds/contacts/' + user + '/full'
+    url = _contactsurl + user + '/full'
     if contactid:
         # use PUT to update existing contact
         url += '/' + contactid
         headers['X-HTTP-Method-Override'] = 'PUT'
-    gcontactsrequest = urllib2.Request(url, contactxml, headers)
     # this will fail with Error 412: Precondition Failed if sent contact exists
     # and has different etag - i.e. has been changed on Google since last sync.
     # Error 404: Not Found if contact has been deleted
     # TODO: handle this somehow
     # perhaps make sure we want to overwrite then delete + add new
     try:
-        gcontactsconn = urllib2.urlopen(gcontactsrequest)
-    except urllib2.HTTPError, msg:
+        gcontactsconn = gdataopen('POST', url, auth, contactxml, headers)
+    except transport.HTTPError, msg:
         logger.error(url)
         logger.error(headers)
         logger.error(contactxml)
         handleconnectionerror(msg)
         return contactxml
-    # convert to unicode
-    gencoding = _encoding
-    for h in gcontactsconn.headers['content-type'].split(';'):
-        if 'charset' in h:
-            gencoding = h.split('=')[1]
-    gcontacts = gcontactsconn.read()
-    gcontactsconn.close()
-    return unicode(gcontacts, gencoding)
+    return readresponse(gcontactsconn)
+
+def sendbatch(user, auth, operations):
+    """send contacts to google in gdata batch feeds
+    operations is a list of (operation, batch id, vcard), where operation is
+    one of insert, update, delete; they are sent 'batchsize' at a time
+    return dictionary of batch id: (status code, reason, vcard from google)
+    http://code.google.com/apis/gdata/docs/batch.html"""
+    headers = {'Content-Type': 'application/atom+xml'}
+    url = _contactsurl + user + '/full/batch'
+    batchsize = int(options.get('batchsize', '100'))
+    def send(start):
+        feed = vcf2xml.batchFeed()
+        for operation, batchid, vcard in operations[start:start + batchsize]:
+            entry = vcf2xml.toXml(vcard)
+            if operation in ('update', 'delete'):
+                # google finds the contact from the entry's id, which
+                # vcf2xml makes for a fixed account
+                idtag = vcf2xml.addNS('id', 'atom')
+                element = entry.find(idtag)
+                if element is None:
+                    element = vcf2xml.ET.SubElement(entry, idtag)
+                element.text = _contactsurl + user + '/full/' + batchid
+            vcf2xml.addBatch(feed, entry, operation, batchid)
+        batchxml = vcf2xml.ET.tostring(feed, encoding=_encoding)
+        logger.debug(u'Sending batch of {0} operations.'.format(
+                len(operations[start:start + batchsize])))
+        return xml2vcf.readBatch(readresponse(gdataopen('POST', url, auth,
+                batchxml, headers)))
+    results = {}
+    # batches are sent from the scheduler's threads, and only sent again if
+    # google says it did not carry them out, as inserts would be made twice
+    for start, response, error in googlecalls.map(send,
+            xrange(0, len(operations), batchsize), scheduler.NOTAPPLIED):
+        if error is not None:
+            if not isinstance(error, transport.HTTPError):
+                raise error
+            handleconnectionerror(error)
+            continue
+        for batchid, operation, code, reason, vcard in response:
+            results[batchid] = (code, reason, vcard)
+    return results
 
 def handleconnectionerror(msg):
     """ deal with errors from google connection """
-    # TODO: not sure why these come as errors instead of response codes...
     # see http://code.google.com/apis/gdata/docs/2.0/reference.html#HTTPStatusCodes
-    if "404" in msg:
+    if msg.code == 404:
         # contact not found
         logger.error(u"Contact not found on Google.")
         return
-    elif "412" in msg:
+    elif msg.code == 412:
         # changed since last sync
         logger.error(u"Contact changed on Google since last sync.")
     logger.error(msg)
 
-def comparevcards(vcard, localvcard, auth):
+def _unicode(value):
+    """ value with its byte strings decoded, so that cards parsed from the
+    file (unicode) and from google's xml (ascii str) compare equal """
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, (list, tuple)):
+        return [_unicode(v) for v in value]
+    return value
+
+def fingerprint(vcard):
+    """ hash of a contact's content, ignoring volatile fields """
+    lines = []
+    for component in vcard.getChildren():
+        if component.name in _volatile:
+            continue
+        params = sorted(component.params.items())
+        value = component.value
+        if hasattr(value, '__dict__'):
+            # vobject Name, Address
+            value = sorted(value.__dict__.items())
+        lines.append(u'{0};{1}:{2}'.format(component.name,
+                repr(_unicode(params)), repr(_unicode(value))))
+    lines.sort()
+    return hashlib.md5(u'\n'.join(lines).encode('utf-8')).hexdigest()
+
+def cachedfingerprint(vcard, side, key):
+    """ fingerprint of a contact, reused from contactdb['fingerprints'] if
+    this side's copy of it had the same key when it was stored
+    side is 'remote', keyed on the contact's etag, or 'local', keyed on the
+    md5 of its bytes in the contacts file; unlike REV, both change with the
+    content. Nothing is cached without a key. """
+    if key is None:
+        return fingerprint(vcard)
+    fingerprints = contactdb['fingerprints']
+    uid = vcard.uid.value
+    entry = fingerprints.get(uid)
+    if not isinstance(entry, dict):
+        # not stored, or stored before each side had its own
+        entry = {}
+    if side in entry and entry[side][0] == key:
+        return entry[side][1]
+    fp = fingerprint(vcard)
+    entry[side] = (key, fp)
+    fingerprints[uid] = entry
+    return fp
+
+def updateremote(localvcard, auth, batch=None):
+    """ send local version of a contact to google
+    if batch is a list, queue the update there to be sent by sendbatch """
+    if batch is not None:
+        batch.append(('update', localvcard.uid.value, localvcard))
+        return localvcard
+    xmlobj = vcf2xml.toXml(localvcard)
+    xml = vcf2xml.ET.tostring(xmlobj, encoding=_encoding)
+    response = sendcontact(options['user'], auth, xml, localvcard.uid.value)
+    return xml2vcf.readXml(response)[0]
+
+def comparevcards(vcard, localvcard, auth, batch=None, localkey=None):
     """ look for local version of this vcard and compare
-    should return tuple(action, xml, id, name) """
-    id = vcard.uid.value
+    should return tuple(action, xml, id, name)
+    remote updates are queued in batch if given; localkey is the md5 of the
+    local card's bytes if it is unchanged from the contacts file """
     name = vcard.fn.value
-    # compare
-    if vcard.serialize() == localvcard.serialize():
-        return localvcard
+    etag = getetag(vcard)
+    if cachedfingerprint(vcard, 'remote', etag) == \
+            cachedfingerprint(localvcard, 'local', localkey):
+        # keep the local card, so it is not written again, unless the remote
+        # one has a newer etag to record
+        if etag == getetag(localvcard):
+            return localvcard
+        return vcard
     # compare REV strings
     if 'rev' in vcard.contents and 'rev' in localvcard.contents:
         # TODO google returns utc times - should make this timezone aware
@@ -200,10 +426,7 @@ def comparevcards(vcard, localvcard, auth):
             return vcard
         elif localvcardrev > vcardrev:
             # update remote
-            xmlobj = vcf2xml.toXml(localvcard)
-            xml = vcf2xml.ET.tostring(xmlobj, encoding=_encoding)
-            response = sendcontact(options['user'], auth, xml, id)
-            localvcard = xml2vcf.readXml(response)[0]
+            localvcard = updateremote(localvcard, auth, batch)
             logger.info(u'Remote version of contact "{0}" updated.'.format(name))
             return localvcard
         else:
@@ -215,10 +438,7 @@ def comparevcards(vcard, localvcard, auth):
     r = u'Contact "{0}" differs: '.format(name)
     if options['defaultresolution'] == 'prefer local' \
             or runoptions.preferlocal is True:
-        xmlobj = vcf2xml.toXml(localvcard)
-        xml = vcf2xml.ET.tostring(xmlobj, encoding=_encoding)
-        response = sendcontact(options['user'], auth, xml, id)
-        localvcard = xml2vcf.readXml(response)[0]
+        localvcard = updateremote(localvcard, auth, batch)
         logger.info(r + u'remote version updated.')
         return localvcard
     elif options['defaultresolution'] == 'prefer remote' \
@@ -235,37 +455,50 @@ def comparevcards(vcard, localvcard, auth):
 
 def getlocalcontacts():
     """ open local contacts, return dict of (uid, contact) """
-    # open contacts file
-    logger.debug(u'Opening local contacts file.')
     contactsfilename = os.path.expanduser(options['contacts'])
-    contactsfile = codecs.open(contactsfilename, 'r', _encoding)
-    contactstext = contactsfile.read()
-    contactsfile.close()
-    # copy file to archive version
-    # TODO do this smarter and optionally
-    archivefilename = contactsfilename + '.' + \
-            datetime.now().strftime(_dtformat)
-    shutil.copy(contactsfilename, archivefilename)
-    # parse into dictionary of contacts
+    # keep a snapshot of the file
+    if options.get('snapshots', 'true') == 'true':
+        logger.debug(u'Taking snapshot of local contacts file.')
+        getsnapshotstore().save(contactsfilename,
+                datetime.now().strftime(_dtformat))
+    # parse into dictionary of contacts, only cards changed since the last
+    # sync are parsed now, the rest when they are used
     logger.debug(u'Parsing contacts.')
-    def getOrMakeUid(c):
-        if 'uid' in c.contents:
-            return (c.uid.value, c)
-        else:
-            return (c.fn.value, c)
-    localcontacts = dict([getOrMakeUid(c) for c
-            in vobject.readComponents(contactstext)])
+    processes = int(options.get('parseprocesses', '0')) or \
+            multiprocessing.cpu_count()
+    localcontacts = vcardindex.CardIndex(contactsfilename, _encoding,
+            contactdb.get('cardindex'), processes)
+    logger.debug(u'Parsed {0} of {1} contacts.'.format(localcontacts.parsed,
+            len(localcontacts)))
     return localcontacts
 
+def getsnapshotstore():
+    """ snapshot store for the contacts file """
+    contactsfilename = os.path.expanduser(options['contacts'])
+    directory = os.path.expanduser(options.get('snapshotdir',
+            contactsfilename + '.snapshots'))
+    return snapshots.SnapshotStore(directory,
+            int(options.get('snapshotkeep', '30')))
+
+def restore(timestamp):
+    """ replace the contacts file with a snapshot """
+    contactsfilename = os.path.expanduser(options['contacts'])
+    restored = getsnapshotstore().restore(timestamp, contactsfilename)
+    if restored is None:
+        logger.error(u'No snapshot matching {0}.'.format(timestamp))
+        return 2
+    logger.info(u'Restored snapshot {0}.'.format(restored))
+
 def getlocalchanges(localcontacts):
     # make list of recently changed local contact ids
     localchanges = []
     if 'lastsync' in contactdb.keys():
         lastsync = datetime.strptime(contactdb['lastsync'], _dtformat)
         logger.debug(u'Looking for changes since {0}'.format(contactdb['lastsync']))
-        for cuid, c in localcontacts.items():
-            if 'rev' in c.contents:
-                crev = datetime.strptime(c.rev.value, _dtformat)
+        for cuid in localcontacts.keys():
+            rev = localcontacts.rev(cuid)
+            if rev is not None:
+                crev = datetime.strptime(rev, _dtformat)
                 if crev > lastsync:
                     localchanges.append(cuid)
     if len(localchanges):
@@ -287,72 +520,76 @@ def getlocalchanges(localcontacts):
     return list(localadditions), localchanges, list(localdeletions)
 
 def getallfromgoogle():
-    """ get all contacts from google and save to file """
+    """ get all contacts from google, yield vcards """
     auth = authenticate(options['user'], options['password'])
-    data = {'max-results': '2000'}
-    contactsxml = getcontacts(options['user'], auth, data=data)
-    return contactsxml
+    return getcontactfeed(options['user'], auth)
+
+class XmlSaver():
+    """ wrap a response, saving the xml read from it to a file """
+    def __init__(self, response, page=1):
+        self.response = response
+        xmlfilename = 'google-contacts-{0}-{1}.xml'.format(
+                datetime.now().strftime(_dtformat), page)
+        self.xmlfile = open(xmlfilename, 'wb')
 
-def savexml(xml):
-    xmlfilename = 'google-contacts-{0}.xml'.format(datetime.now().strftime(_dtformat))
-    xmlfile = codecs.open(xmlfilename, 'w', _encoding)
-    xmlfile.write(xml)
-    xmlfile.close()
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        self.xmlfile.write(data)
+        return data
+
+    def close(self):
+        self.xmlfile.close()
+        self.response.close()
 
 def execute():
+    if 'fingerprints' not in contactdb:
+        contactdb['fingerprints'] = {}
     localcontacts = getlocalcontacts()
     localadditions, localchanges, localdeletions = getlocalchanges(localcontacts)
 
     # get (recently changed) contacts from google
-    data = {'max-results': len(localcontacts) + 50}
+    data = {}
     if 'lastsync' in contactdb.keys() and not runoptions.getall:
         data['updated-min'] = contactdb['lastsync']
     logger.debug(u'Logging into Google Contacts.')
     auth = authenticate(options['user'], options['password'])
     logger.debug(u'Retrieving contact list.')
-    contactsxml = getcontacts(options['user'], auth, data=data)
-    # store xml for reference
-    if options['loglevel'] == 'debug':
-        savexml(contactsxml)
-
-    # parse into individual vcards
-    logger.debug(u'Parsing contacts from Google.')
-    contacts = xml2vcf.readXml(contactsxml)
-    logger.info(u'Received {0} contacts from Google.'.format(len(contacts)))
-    for c in contacts:
-        if c.uid.value in localdeletions:
-            # don't bother comparing if we're going to delete it anyway
-            logger.debug(u'Ignoring "{0}": in deletion list.'.format(c.fn.value))
-            continue
 
-        if c.uid.value in localcontacts:
-            #logger.debug(u'Comparing "{0}".'.format(c.fn.value))
-            localcontacts[c.uid.value] = comparevcards(c,
-                    localcontacts[c.uid.value], auth)
-        elif 'fn' in c.contents:
-            localcontacts[c.uid.value] = c
-            logger.info(u'New contact "{0}" added.'.format(c.fn.value))
-        else:
-            logger.debug(u'New unparseable remote contact ' +
-                    u'"{0}" ignored.'.format(c.uid.value))
+    # parse into individual vcards, page by page
+    # updates to google are collected and sent in batches at the end
+    batch = []
+    received = 0
+    with contactdb.transaction():
+        for c in getcontactfeed(options['user'], auth, data=data):
+            received += 1
+            if c.uid.value in localdeletions:
+                # don't bother comparing if we're going to delete it anyway
+                logger.debug(u'Ignoring "{0}": in deletion list.'.format(
+                        c.fn.value))
+                continue
+
+            if c.uid.value in localcontacts:
+                #logger.debug(u'Comparing "{0}".'.format(c.fn.value))
+                localcontacts[c.uid.value] = comparevcards(c,
+                        localcontacts[c.uid.value], auth, batch,
+                        localcontacts.digest(c.uid.value))
+            elif 'fn' in c.contents:
+                localcontacts[c.uid.value] = c
+                logger.info(u'New contact "{0}" added.'.format(c.fn.value))
+            else:
+                logger.debug(u'New unparseable remote contact ' +
+                        u'"{0}" ignored.'.format(c.uid.value))
 
-        if c.uid.value in localchanges:
-            # already compared, so delete from localchanges list
-            del localchanges[localchanges.index(c.uid.value)]
+            if c.uid.value in localchanges:
+                # already compared, so delete from localchanges list
+                del localchanges[localchanges.index(c.uid.value)]
+    logger.info(u'Received {0} contacts from Google.'.format(received))
 
     # local additions
     # TODO: additions go to general contact list, not My Contacts, and have to
     # be moved manually in Gmail. Fix this.
-    logger.debug(u'Sending local additions.')
     for n in localadditions:
-        xmlobj = vcf2xml.toXml(localcontacts[n])
-        xml = vcf2xml.ET.tostring(xmlobj, encoding=_encoding)
-        response = sendcontact(options['user'], auth, xml)
-        localvcard = xml2vcf.readXml(response)[0]
-        # replace original with uid/etagged version from google
-        del localcontacts[n]
-        localcontacts[localvcard.uid.value] = localvcard
-        logger.info(u'Local contact "{0}" added to Google.'.format(n))
+        batch.append(('insert', n, localcontacts[n]))
 
     # TODO: deal with remote deletions
     # remote deletions should have only <atom:id> and <gd:deleted> for 30 days
@@ -365,43 +602,80 @@ def execute():
         # sendcontact returns False if no contactid specified
         # add to list to delete until this is worked out
         logger.debug(u'Recording deletion of contact {0}.'.format(cuid))
-        try:
-            contactdb['todelete'].append(cuid)
-            # NB Shelf.append() is dependent on writeback=True
-        except KeyError:
-            contactdb['todelete'] = [cuid]
-        pass
+        contactdb['todelete'] = contactdb.get('todelete', []) + [cuid]
 
     # remaining localchanges
     logger.debug(u'Examining local changes.')
-    for cuid in localchanges:
-        logger.debug(u'Retrieving "{0}".'.format(localcontacts[cuid].fn.value))
-        contactxml = getcontacts(options['user'], auth, cuid)
-        if contactxml is not None:
-            logger.debug(u'Parsing contact from Google.')
-            contact = xml2vcf.readXml(contactxml)[0]
+    # retrieve concurrently, but compare in order so results match a serial run
+    remotechanges = []
+    if len(localchanges):
+        logger.debug(u'Retrieving {0} contacts.'.format(len(localchanges)))
+        etags = [getetag(localcontacts[cuid]) for cuid in localchanges]
+        fetched = {}
+        for (cuid, etag), contact, error in googlecalls.map(
+                lambda (cuid, etag): fetchcontact(auth, cuid, etag),
+                zip(localchanges, etags)):
+            if error is not None:
+                raise error
+            fetched[cuid] = contact
+        remotechanges = [fetched[cuid] for cuid in localchanges]
+    for cuid, contact in zip(localchanges, remotechanges):
+        if contact is NOTMODIFIED:
+            # unchanged on google since the last sync, so local is newer
+            logger.debug(u'"{0}" not changed on Google.'.format(
+                    localcontacts[cuid].fn.value))
+            localcontacts[cuid] = updateremote(localcontacts[cuid], auth,
+                    batch)
+        elif contact is not None:
             logger.debug(u'Comparing "{0}".'.format(localcontacts[cuid].fn.value))
-            localcontacts[cuid] = comparevcards(contact, localcontacts[cuid], auth)
+            localcontacts[cuid] = comparevcards(contact, localcontacts[cuid],
+                    auth, batch, localcontacts.digest(cuid))
         else:
             logger.error(u'Contact not found at Google.')
 
+    # send additions and updates
+    logger.debug(u'Sending local additions and updates.')
+    results = sendbatch(options['user'], auth, batch)
+    for operation, n, vcard in batch:
+        if n not in results:
+            logger.error(u'No response from Google for contact {0}.'.format(n))
+            continue
+        code, reason, localvcard = results[n]
+        if localvcard is None:
+            logger.error(u'Sending contact {0} to Google failed: {1} {2}'.format(
+                    n, code, reason))
+            continue
+        # replace original with uid/etagged version from google
+        del localcontacts[n]
+        localcontacts[localvcard.uid.value] = localvcard
+        if operation == 'insert':
+            logger.info(u'Local contact "{0}" added to Google.'.format(n))
+
     # write out contacts file
-    logger.debug(u'Writing new local file.')
-    contactsfile = codecs.open(os.path.expanduser(options['contacts']), 'w',
-            _encoding)
-    # sort list by cuid so diffs are easier
-    for cuid, c in sorted(localcontacts.items()):
-        contactsfile.write(c.serialize().decode(_encoding))
-        # should this be?
-        #contactsfile.write(unicode(c.serialize(), _encoding))
-    contactsfile.close()
+    if localcontacts.write():
+        logger.debug(u'Wrote new local file.')
+    else:
+        logger.debug(u'No local changes, contacts file not written.')
 
     # set last sync time in config: now() or utcnow()?
     logger.debug(u'Recording sync details.')
-    contactdb['lastsync'] = datetime.strftime(datetime.utcnow(), _dtformat)
-    contactdb['cuids'] = localcontacts.keys()
+    with contactdb.transaction():
+        contactdb['lastsync'] = datetime.strftime(datetime.utcnow(),
+                _dtformat)
+        contactdb['cuids'] = localcontacts.keys()
+        contactdb['cardindex'] = localcontacts.index()
+        fingerprints = contactdb['fingerprints']
+        for cuid in fingerprints.keys():
+            if cuid not in localcontacts:
+                del fingerprints[cuid]
     contactdb.close()
 
 if __name__ == '__main__':
-    execute()
+    if runoptions.listsnapshots:
+        for timestamp, digest in getsnapshotstore().snapshots():
+            print timestamp, digest
+    elif runoptions.restore:
+        sys.exit(restore(runoptions.restore))
+    else:
+        execute()
 
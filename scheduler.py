@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Rate limited, retrying calls to Google for bulk operations"""
+
+import time, random, threading, logging, Queue
+from email.utils import parsedate_tz, mktime_tz
+import transport
+
+# responses worth trying again, and those meaning we are going too fast
+_retry = (403, 429, 500, 502, 503, 504)
+_congestion = (403, 429, 503)
+# responses saying a request was not carried out, the only ones to retry
+# for calls that create data, which would otherwise be created twice
+NOTAPPLIED = (429, 503)
+
+def parseretryafter(value):
+    """ seconds to wait from a Retry-After header, which is either a number
+    of seconds or a date; None if missing or unreadable """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, mktime_tz(date) - time.time())
+
+def httpstatus(error):
+    """ (status, Retry-After seconds) of a transport.HTTPError, or None for
+    errors that should not be retried """
+    if isinstance(error, transport.HTTPError):
+        return error.code, parseretryafter(error.headers.getheader(
+                'retry-after'))
+    return None
+
+class TokenBucket():
+    """ allows rate calls a second on average, and up to burst at once """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.until = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ wait for a token """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                wait = self.until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """ hand out no tokens for the next seconds """
+        with self.lock:
+            self.until = max(self.until, time.time() + seconds)
+            self.tokens = 0
+
+class Scheduler():
+    """ runs calls to Google from a few threads, at most rate a second
+
+    the number of calls in progress grows by one for each round of calls
+    that succeed, up to workers, and is halved when Google says it is
+    overloaded or over quota (additive increase, multiplicative decrease).
+    Failed calls are tried again after a random wait that doubles each
+    time, or as long as a Retry-After header asks.
+    classify(error) returns (status, retry after seconds or None) for
+    errors that might succeed if tried again, or None.
+    """
+    def __init__(self, rate=20.0, burst=20, workers=4, retries=5,
+            backoff=1.0, maxbackoff=64.0, classify=httpstatus, log=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.classify = classify
+        self.logger = log or logging.getLogger(__name__)
+        # calls allowed in progress, and in progress now
+        self.limit = 1.0
+        self.active = 0
+        self.cond = threading.Condition()
+
+    def _acquire(self):
+        with self.cond:
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+
+    def _release(self, status=None):
+        with self.cond:
+            self.active -= 1
+            if status in _congestion:
+                self.limit = max(1.0, self.limit / 2)
+                self.logger.debug(u'Google is busy, {0} requests at a ' \
+                        'time.'.format(int(self.limit)))
+            elif status is None:
+                self.limit = min(float(self.workers),
+                        self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def _wait(self, attempt, retryafter):
+        """ seconds to wait before trying again """
+        wait = random.uniform(0, min(self.maxbackoff,
+                self.backoff * 2 ** attempt))
+        if retryafter is not None:
+            wait = max(wait, retryafter)
+        return wait
+
+    def _attempt(self, func, args, kwargs, attempt, retrystatus=_retry):
+        """ make one call, return (result, error, seconds to wait before
+        retrying or None) """
+        self._acquire()
+        self.bucket.take()
+        try:
+            result = func(*args, **kwargs)
+        except Exception, error:
+            retry = self.classify(error)
+            status = retry and retry[0]
+            self._release(status or 0)
+            if status not in retrystatus or attempt >= self.retries:
+                return None, error, None
+            wait = self._wait(attempt, retry[1])
+            if retry[1] is not None:
+                self.bucket.pause(wait)
+            self.logger.debug(u'Error {0}, trying again in {1:.1f}s.'.format(
+                    status, wait))
+            return None, error, wait
+        self._release()
+        return result, None, None
+
+    def call(self, func, *args, **kwargs):
+        """ call func, trying again if it fails and might succeed later
+        raise the last error if it does not """
+        return self.callretrying(_retry, func, *args, **kwargs)
+
+    def callretrying(self, retrystatus, func, *args, **kwargs):
+        """ call func, trying again only after errors with a status in
+        retrystatus, e.g. NOTAPPLIED for calls that create data """
+        for attempt in xrange(self.retries + 1):
+            result, error, wait = self._attempt(func, args, kwargs, attempt,
+                    retrystatus)
+            if error is None:
+                return result
+            if wait is None:
+                raise error
+            time.sleep(wait)
+
+    def map(self, func, items, retrystatus=_retry):
+        """ call func(item) for each item from worker threads
+        yield (item, result, error) in the order calls finish, where error
+        is None, or the exception raised after the last try; the caller's
+        thread is free to record results, e.g. in a database. Calls not
+        started when the caller stops reading are not made. Only errors
+        with a status in retrystatus are tried again """
+        todo = Queue.Queue()
+        done = Queue.Queue()
+        stop = threading.Event()
+        count = 0
+        for item in items:
+            todo.put((item, 0))
+            count += 1
+        def requeue(task):
+            if not stop.is_set():
+                todo.put(task)
+        def worker():
+            while True:
+                task = todo.get()
+                if task is None or stop.is_set():
+                    return
+                item, attempt = task
+                result, error, wait = self._attempt(func, (item,), {},
+                        attempt, retrystatus)
+                if wait is None:
+                    done.put((item, result, error))
+                else:
+                    # sleep without holding up the other calls
+                    timer = threading.Timer(wait, requeue,
+                            ((item, attempt + 1),))
+                    timer.daemon = True
+                    timer.start()
+        threads = [threading.Thread(target=worker)
+                for i in xrange(min(self.workers, count))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for i in xrange(count):
+                while True:
+                    try:
+                        # a timeout lets KeyboardInterrupt through
+                        result = done.get(True, 1)
+                    except Queue.Empty:
+                        continue
+                    yield result
+                    break
+        finally:
+            # the caller may have stopped early, drop the calls not made
+            stop.set()
+            while True:
+                try:
+                    todo.get_nowait()
+                except Queue.Empty:
+                    break
+            for thread in threads:
+                todo.put(None)
+            for thread in threads:
+                thread.join()
+
+def fromoptions(options, classify=httpstatus, log=None):
+    """ scheduler set up from config options """
+    rate = float(options.get('ratelimit', '20'))
+    return Scheduler(rate=rate,
+            burst=int(options.get('ratelimitburst', int(max(1, rate)))),
+            workers=int(options.get('concurrency', '4')),
+            retries=int(options.get('retries', '5')),
+            backoff=float(options.get('backoff', '1')),
+            classify=classify, log=log)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Compressed, deduplicated snapshots of a file"""
+
+import os, re, gzip, hashlib
+import fileutil
+
+# names of the objects a store writes, other files are left alone
+_objectname = re.compile(r'^[0-9a-f]{40}\.gz$')
+
+class SnapshotStore():
+    """ snapshots of a file kept in a directory
+
+    each distinct content is stored once, gzipped, as <sha1>.gz; the manifest
+    lists one 'timestamp sha1' line per snapshot. Only the newest 'keep'
+    snapshots are kept.
+    """
+    def __init__(self, directory, keep=30):
+        self.directory = directory
+        self.keep = keep
+        self.manifest = os.path.join(directory, 'manifest')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def snapshots(self):
+        """ list of (timestamp, sha1), oldest first """
+        if not os.path.isfile(self.manifest):
+            return []
+        manifest = open(self.manifest, 'rb')
+        snapshots = [tuple(line.split()) for line in manifest if line.strip()]
+        manifest.close()
+        return snapshots
+
+    def _object(self, digest):
+        return os.path.join(self.directory, digest + '.gz')
+
+    def _writemanifest(self, snapshots):
+        fileutil.atomicwrite(self.manifest,
+                ''.join(['{0} {1}\n'.format(t, d) for t, d in snapshots]))
+
+    def save(self, filename, timestamp):
+        """ take a snapshot of filename, return its sha1
+        nothing is added if the file is the same as the latest snapshot """
+        sha1 = hashlib.sha1()
+        source = open(filename, 'rb')
+        for block in iter(lambda: source.read(65536), ''):
+            sha1.update(block)
+        digest = sha1.hexdigest()
+        snapshots = self.snapshots()
+        if snapshots and snapshots[-1][1] == digest:
+            source.close()
+            return digest
+        if not os.path.isfile(self._object(digest)):
+            source.seek(0)
+            temp, tempname = fileutil.tempfor(self._object(digest))
+            compressed = gzip.GzipFile(fileobj=temp, mode='wb')
+            for block in iter(lambda: source.read(65536), ''):
+                compressed.write(block)
+            compressed.close()
+            temp.close()
+            fileutil.replace(tempname, self._object(digest), 0600)
+        source.close()
+        snapshots.append((timestamp, digest))
+        self._writemanifest(snapshots)
+        self.prune()
+        return digest
+
+    def prune(self):
+        """ forget all but the newest snapshots, delete unused objects """
+        snapshots = self.snapshots()
+        if len(snapshots) > self.keep:
+            snapshots = snapshots[-self.keep:]
+            self._writemanifest(snapshots)
+        used = set([d + '.gz' for t, d in snapshots])
+        for name in os.listdir(self.directory):
+            if _objectname.match(name) and name not in used:
+                os.remove(os.path.join(self.directory, name))
+
+    def find(self, timestamp):
+        """ newest snapshot whose timestamp starts with timestamp
+        return (timestamp, sha1) or None """
+        for t, d in reversed(self.snapshots()):
+            if t.startswith(timestamp):
+                return t, d
+        return None
+
+    def restore(self, timestamp, filename):
+        """ write the snapshot matching timestamp to filename
+        return the snapshot's full timestamp, or None if there is none """
+        snapshot = self.find(timestamp)
+        if snapshot is None:
+            return None
+        compressed = gzip.open(self._object(snapshot[1]), 'rb')
+        temp, tempname = fileutil.tempfor(filename)
+        for block in iter(lambda: compressed.read(65536), ''):
+            temp.write(block)
+        compressed.close()
+        temp.close()
+        fileutil.replace(tempname, filename)
+        return snapshot[0]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Databases of sync state, kept in sqlite or a shelve file"""
+
+import os.path, shelve, whichdb
+import sqlite3, cPickle
+from contextlib import contextmanager
+from UserDict import DictMixin
+
+def open(filename, tables=(), backend='sqlite'):
+    """ open the state database for filename
+    tables are the keys holding large dictionaries, which the sqlite backend
+    stores one row per item. An existing shelve database is copied into a
+    new sqlite one on first use. """
+    if backend == 'shelve':
+        return ShelveStore(filename)
+    sqlitefilename = filename + '.sqlite'
+    migrate = not os.path.exists(sqlitefilename) and whichdb.whichdb(filename)
+    store = SQLiteStore(sqlitefilename, tables)
+    if migrate:
+        old = shelve.open(filename, 'r')
+        with store.transaction():
+            for key in old.keys():
+                store[key] = old[key]
+        old.close()
+    return store
+
+class ShelveStore(shelve.DbfilenameShelf):
+    """ shelve database, every entry used is kept in memory and written back
+    on sync() """
+    def __init__(self, filename):
+        shelve.DbfilenameShelf.__init__(self, filename, writeback=True)
+
+    @contextmanager
+    def transaction(self):
+        yield self
+        self.sync()
+
+def _dumps(value):
+    return sqlite3.Binary(cPickle.dumps(value, 2))
+
+def _loads(value):
+    return cPickle.loads(str(value))
+
+class Table(DictMixin):
+    """ a dictionary stored one item per row of an sqlite table """
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        db.execute('CREATE TABLE IF NOT EXISTS "{0}" ' \
+                '(key TEXT PRIMARY KEY, value BLOB)'.format(name))
+
+    def __getitem__(self, key):
+        row = self.db.execute('SELECT value FROM "{0}" WHERE key = ?'.format(
+                self.name), (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO "{0}" (key, value) ' \
+                'VALUES (?, ?)'.format(self.name), (key, _dumps(value)))
+
+    def __delitem__(self, key):
+        cursor = self.db.execute('DELETE FROM "{0}" WHERE key = ?'.format(
+                self.name), (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.db.execute('SELECT 1 FROM "{0}" WHERE key = ?'.format(
+                self.name), (key,)).fetchone() is not None
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM "{0}"'.format(
+                self.name)).fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self.db.execute(
+                'SELECT key FROM "{0}"'.format(self.name))]
+
+    def items(self):
+        return [(row[0], _loads(row[1])) for row in self.db.execute(
+                'SELECT key, value FROM "{0}"'.format(self.name))]
+
+    def clear(self):
+        self.db.execute('DELETE FROM "{0}"'.format(self.name))
+
+class SQLiteStore():
+    """ sqlite database with the same interface as a shelve
+    keys listed in tables are Table dictionaries, anything else is stored
+    whole. Changes are committed by sync(), close() or at the end of a
+    transaction() block. """
+    def __init__(self, filename, tables=()):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS state ' \
+                '(key TEXT PRIMARY KEY, value BLOB)')
+        self.tables = dict([(name, Table(self.db, name)) for name in tables])
+        self.db.commit()
+        # transaction() blocks open
+        self.depth = 0
+
+    def __getitem__(self, key):
+        if key in self.tables:
+            return self.tables[key]
+        row = self.db.execute('SELECT value FROM state WHERE key = ?',
+                (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _loads(row[0])
+
+    def __setitem__(self, key, value):
+        if key in self.tables:
+            table = self.tables[key]
+            if value is not table:
+                table.clear()
+                table.update(value)
+            return
+        self.db.execute('INSERT OR REPLACE INTO state (key, value) ' \
+                'VALUES (?, ?)', (key, _dumps(value)))
+
+    def __delitem__(self, key):
+        if key in self.tables:
+            self.tables[key].clear()
+            return
+        cursor = self.db.execute('DELETE FROM state WHERE key = ?', (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.tables or self.db.execute(
+                'SELECT 1 FROM state WHERE key = ?', (key,)).fetchone() \
+                is not None
+
+    has_key = __contains__
+
+    def keys(self):
+        return [row[0] for row in self.db.execute('SELECT key FROM state')] \
+                + self.tables.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    @contextmanager
+    def transaction(self):
+        """ commit changes made in the block, or roll them back on error
+        sync() and nested blocks leave that to the outermost block """
+        self.depth += 1
+        try:
+            yield self
+        except:
+            self.depth -= 1
+            if not self.depth:
+                self.db.rollback()
+            raise
+        else:
+            self.depth -= 1
+            if not self.depth:
+                self.db.commit()
+
+    def sync(self):
+        if not self.depth:
+            self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
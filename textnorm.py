@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Whitespace and entity clean up of contact text, shared by the converters
+
+each function gives the same result as the loops the converters used to
+run, in one pass over the text.
+"""
+
+import re
+
+_spaces = re.compile(r' {2,}')
+_runs = re.compile(r'(\n?)( +)')
+
+def _halve(k, newline):
+    """ length of a run of k spaces after replace('  ', ' '), and after
+    replace('\n ', '\n') if it follows a newline """
+    k = (k + 1) // 2
+    if newline and k:
+        k -= 1
+    return k
+
+def stripAndJoin(string, removeNewLines=True, newlineSpaces=False):
+    """ remove \n, \r, double spaces from string
+    the same as replacing '  ' with ' ' and stripping until no double space
+    is left; with newlineSpaces a space after each newline is also dropped
+    in every round. A string without double spaces is returned as it is. """
+    if removeNewLines:
+        string = string.replace('\n', '').replace('\r', '')
+    if '  ' not in string:
+        return string
+    if not newlineSpaces or '\n ' not in string:
+        # one replace is enough for most fields
+        string = string.replace('  ', ' ')
+        if '  ' in string:
+            string = _spaces.sub(' ', string)
+        return string.strip()
+    # runs after a newline shrink each round until every run is one space
+    # at most, so how short they end up depends on the longest run
+    core = string.strip()
+    rounds = 1
+    for match in _runs.finditer(core):
+        k, newline, n = len(match.group(2)), match.group(1), 0
+        while k > 1:
+            k = _halve(k, newline)
+            n += 1
+        rounds = max(rounds, n)
+    def shrink(match):
+        if not match.group(1):
+            return ' '
+        k = len(match.group(2))
+        for i in xrange(rounds):
+            if k == 0:
+                break
+            k = _halve(k, True)
+        return '\n' + ' ' * k
+    return _runs.sub(shrink, core)
+
+def unEntity(text):
+    """ remove incorrect xml entities
+    each u'\xc3' and the character after it are utf-8 read as latin-1, and
+    are replaced by the character they should have been """
+    if unichr(195) not in text:
+        return text
+    result = []
+    chars = iter(text)
+    for c in chars:
+        while c == unichr(195):
+            try:
+                c = unichr(ord(next(chars)) + 64)
+            except StopIteration:
+                raise IndexError('string index out of range')
+        result.append(c)
+    return u''.join(result)
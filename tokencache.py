@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Authentication tokens kept between runs"""
+
+import os.path, time
+import fileutil
+
+class TokenCache():
+    """ ClientLogin tokens by user and service, stored in a file only the
+    user can read, each line 'user service expiry token'
+    tokens are used for lifetime seconds after they were issued """
+    def __init__(self, filename, lifetime=24 * 3600):
+        self.filename = filename
+        self.lifetime = lifetime
+
+    def _read(self):
+        tokens = {}
+        if not os.path.isfile(self.filename):
+            return tokens
+        tokenfile = open(self.filename, 'rb')
+        for line in tokenfile:
+            try:
+                user, service, expiry, token = line.split()
+                tokens[(user, service)] = (float(expiry), token)
+            except ValueError:
+                # ignore damaged lines
+                pass
+        tokenfile.close()
+        return tokens
+
+    def _write(self, tokens):
+        now = time.time()
+        fileutil.atomicwrite(self.filename, ''.join(
+                ['{0} {1} {2} {3}\n'.format(user, service, expiry, token)
+                for (user, service), (expiry, token) in tokens.items()
+                if expiry > now]), 0600)
+
+    def get(self, user, service):
+        """ unexpired token for user and service, or None """
+        expiry, token = self._read().get((user, service), (0, None))
+        if expiry > time.time():
+            return token
+        return None
+
+    def set(self, user, service, token):
+        """ store a newly issued token """
+        # read again in case another sync has stored a token meanwhile
+        tokens = self._read()
+        tokens[(user, service)] = (time.time() + self.lifetime, token)
+        self._write(tokens)
+
+    def invalidate(self, user, service):
+        """ forget a token the server has rejected """
+        tokens = self._read()
+        if (user, service) in tokens:
+            del tokens[(user, service)]
+            self._write(tokens)
+
+def fromoptions(options):
+    """ token cache set up from config options """
+    return TokenCache(os.path.expanduser(options.get('tokenfile',
+            '~/.gsynctokens')),
+            float(options.get('tokenlifetime', '24')) * 3600)
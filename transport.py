@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Keep-alive http(s) connections shared by the sync tools"""
+
+import httplib, urlparse, socket
+import os.path, hashlib, zlib, threading, logging
+import fileutil
+
+# defaults, can be set from the config file with configure()
+poolsize = 4
+timeout = 60.0
+logger = logging.getLogger(__name__)
+
+# idle connections by (scheme, host)
+_pool = {}
+_poollock = threading.Lock()
+_redirects = (301, 302, 303, 307)
+# requests safe to send again after a connection fails part way through
+_idempotent = ('GET', 'HEAD', 'PUT', 'DELETE')
+# Retry-After of the last error response in each thread
+_local = threading.local()
+
+def configure(options, log=None):
+    """ set pool size and timeout from config options, and logger to use """
+    global poolsize, timeout, logger
+    poolsize = int(options.get('poolsize', poolsize))
+    timeout = float(options.get('timeout', timeout))
+    if log is not None:
+        logger = log
+
+class HTTPError(Exception):
+    """ error response from the server """
+    def __init__(self, url, code, reason, headers, body):
+        Exception.__init__(self, 'HTTP Error {0}: {1}'.format(code, reason))
+        self.url = url
+        self.code = code
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+class Response():
+    """ a server response, its connection goes back to the pool when the
+    body has been read and the response closed
+    gzip or deflate encoded bodies are decompressed as they are read """
+    def __init__(self, key, conn, response):
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self._decoder = None
+        self._buffer = ''
+        self._eof = False
+        # bytes received, and after decompression
+        self.received = 0
+        self.decoded = 0
+        encoding = response.getheader('content-encoding', '').lower()
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def _decode(self, data):
+        self.received += len(data)
+        if not data:
+            self._eof = True
+            return self._decoder.flush()
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            if self.decoded or self.received != len(data):
+                raise
+            # raw deflate without zlib header
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+    def read(self, amt=None):
+        if self._decoder is None:
+            data = self._response.read(amt)
+            self.received += len(data)
+            self.decoded += len(data)
+            return data
+        if amt is None:
+            data = self._buffer + self._decode(self._response.read())
+            if not self._eof:
+                data += self._decode('')
+            self._buffer = ''
+        else:
+            while len(self._buffer) < amt and not self._eof:
+                self._buffer += self._decode(self._response.read(8192))
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        self.decoded += len(data)
+        return data
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._decoder is not None:
+            logger.debug(u'Received {0} bytes compressed to {1}, ' \
+                    'saved {2}.'.format(self.decoded, self.received,
+                    self.decoded - self.received))
+        if self._response.isclosed() and not self._response.will_close:
+            _release(self._key, self._conn)
+        else:
+            # body not finished or server closing, can't reuse connection
+            self._response.close()
+            self._conn.close()
+        self._conn = None
+
+def _connect(key):
+    """ make a new connection """
+    scheme, host = key
+    if scheme == 'https':
+        return httplib.HTTPSConnection(host, timeout=timeout)
+    return httplib.HTTPConnection(host, timeout=timeout)
+
+def _acquire(key):
+    """ get an idle connection from the pool, or a new one
+    return (connection, reused) """
+    with _poollock:
+        idle = _pool.get(key)
+        if idle:
+            return idle.pop(), True
+    return _connect(key), False
+
+def _release(key, conn):
+    """ return a connection to the pool """
+    with _poollock:
+        idle = _pool.setdefault(key, [])
+        if len(idle) < poolsize:
+            idle.append(conn)
+            return
+    conn.close()
+
+def closeall():
+    """ close all idle connections """
+    with _poollock:
+        for idle in _pool.values():
+            for conn in idle:
+                conn.close()
+        _pool.clear()
+
+def closedidle(error):
+    """ whether error means the server had closed the connection without
+    answering, as it does with connections left idle too long """
+    # httplib 2.7.18 explains the empty status line, older ones give its repr
+    return isinstance(error, httplib.BadStatusLine) and \
+            (error.line in ('', "''") or
+            error.line.startswith('No status line received'))
+
+def request(method, url, body=None, headers=None):
+    """ send a request using a pooled connection, return Response
+    redirects are followed for GET requests
+    compressed responses are asked for, and decompressed when read """
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', 'gzip, deflate')
+    # google only compresses for user agents that mention gzip
+    useragent = headers.get('User-Agent', 'gsync')
+    if 'gzip' not in useragent:
+        headers['User-Agent'] = useragent + ' (gzip)'
+    for i in xrange(5):
+        scheme, host, path, query, fragment = urlparse.urlsplit(url)
+        key = (scheme, host)
+        if query:
+            path += '?' + query
+        conn, reused = _acquire(key)
+        try:
+            conn.request(method, path or '/', body, headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error), error:
+            conn.close()
+            if not reused or not (method in _idempotent or closedidle(error)):
+                # the request may have been acted on, e.g. a batch insert
+                raise
+            # the server closed an idle connection, try again with a new one
+            logger.debug(u'Reconnecting to {0}.'.format(host))
+            conn = _connect(key)
+            conn.request(method, path or '/', body, headers)
+            response = conn.getresponse()
+        result = Response(key, conn, response)
+        _local.retryafter = None
+        if result.status >= 400:
+            _local.retryafter = result.getheader('retry-after')
+        if method == 'GET' and result.status in _redirects:
+            location = result.getheader('location')
+            result.read()
+            result.close()
+            if location:
+                url = urlparse.urljoin(url, location)
+                continue
+        return result
+    return result
+
+def lastretryafter():
+    """ Retry-After header of the last error response received by this
+    thread, for callers that only see an exception without headers """
+    return getattr(_local, 'retryafter', None)
+
+def urlopen(method, url, body=None, headers=None):
+    """ send a request, raise HTTPError for error responses """
+    response = request(method, url, body, headers)
+    if response.status >= 400:
+        errorbody = response.read()
+        response.close()
+        raise HTTPError(url, response.status, response.reason,
+                response.msg, errorbody)
+    return response
+
+def cachedopen(url, headers, cachedir):
+    """ GET url, sending the etag of a cached copy with If-None-Match
+    return a file object to read the body from, either the cached copy if
+    the server says it has not changed, or the response, which is saved to
+    the cache as it is read """
+    bodyname = os.path.join(cachedir, hashlib.sha1(url).hexdigest())
+    etagname = bodyname + '.etag'
+    headers = dict(headers)
+    if os.path.isfile(bodyname) and os.path.isfile(etagname):
+        etagfile = open(etagname, 'rb')
+        headers['If-None-Match'] = etagfile.read()
+        etagfile.close()
+    response = urlopen('GET', url, None, headers)
+    if response.status == 304:
+        response.read()
+        response.close()
+        logger.debug(u'Not modified, using cached {0}.'.format(url))
+        return open(bodyname, 'rb')
+    etag = response.getheader('etag')
+    if etag is None:
+        return response
+    return _CachingReader(response, bodyname, etag)
+
+class _CachingReader():
+    """ a response which is saved to the cache if it is read to the end """
+    def __init__(self, response, bodyname, etag):
+        self.response = response
+        self.bodyname = bodyname
+        self.etag = etag
+        self.complete = False
+        if not os.path.isdir(os.path.dirname(bodyname)):
+            os.makedirs(os.path.dirname(bodyname))
+        self.temp, self.tempname = fileutil.tempfor(bodyname)
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if not data or amt is None:
+            self.complete = True
+        self.temp.write(data)
+        return data
+
+    def close(self):
+        self.response.close()
+        self.temp.close()
+        if self.complete:
+            fileutil.replace(self.tempname, self.bodyname, 0600)
+            fileutil.atomicwrite(self.bodyname + '.etag', self.etag, 0600)
+        else:
+            os.remove(self.tempname)
+
+class GDataHttpClient():
+    """ http client for gdata services using the pooled connections
+    use as service.http_client
+    if reauth is given it is called when the server rejects the token, and
+    returns a new Authorization header to send the request again with """
+    debug = False
+
+    def __init__(self, reauth=None):
+        self.reauth = reauth
+
+    def request(self, operation, url, data=None, headers=None):
+        if not isinstance(url, basestring):
+            # atom.url.Url
+            url = url.to_string()
+        if isinstance(data, list):
+            data = ''.join([str(d) for d in data])
+        elif data is not None and not isinstance(data, basestring):
+            data = str(data)
+        headers = dict(headers or {})
+        if data is not None:
+            headers['Content-Length'] = str(len(data))
+        response = request(operation, url, data, headers)
+        if response.status == 401 and self.reauth is not None and \
+                'Authorization' in headers:
+            response.read()
+            response.close()
+            headers['Authorization'] = self.reauth()
+            response = request(operation, url, data, headers)
+        # gdata reads the whole body, so the connection can go back now
+        return _ReadResponse(response)
+
+class _ReadResponse():
+    """ a response with its body already read """
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self._response = response
+        self._body = response.read()
+        response.close()
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getheaders(self):
+        return self._response.getheaders()
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self._body)
+        body, self._body = self._body[:amt], self._body[amt:]
+        return body
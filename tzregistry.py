@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Timezones by name, each read from the zoneinfo files once a process"""
+
+import os.path, threading
+from dateutil.tz import tzfile, tzlocal, tzutc
+
+_zoneinfo = '/usr/share/zoneinfo'
+# name: tzfile, or None if there is no zoneinfo file for it
+_zones = {}
+_lock = threading.Lock()
+_local = []
+utc = tzutc()
+
+def get(name):
+    """ tzfile for a zone name such as 'Europe/London', or None if there is
+    no such zone """
+    with _lock:
+        if name not in _zones:
+            filename = os.path.join(_zoneinfo, name)
+            if os.path.isfile(filename):
+                _zones[name] = tzfile(filename)
+            else:
+                _zones[name] = None
+        return _zones[name]
+
+def local():
+    """ the local timezone """
+    with _lock:
+        if not _local:
+            _local.append(tzlocal())
+        return _local[0]
+
+def clear():
+    """ forget zones read so far """
+    with _lock:
+        _zones.clear()
+        del _local[:]
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Index of the cards in a vcard file, so that only changed cards are parsed"""
+
+import vobject
+import os, re, hashlib, multiprocessing
+import fileutil
+from UserDict import DictMixin
+
+_begin = re.compile(r'^BEGIN:VCARD', re.I | re.M)
+# fewer new cards than this are parsed without starting processes
+_poolthreshold = 200
+
+def splitcards(data):
+    """ split the contents of a vcard file at BEGIN:VCARD lines
+    return list of (offset, length) """
+    starts = [m.start() for m in _begin.finditer(data)]
+    ends = starts[1:] + [len(data)]
+    return [(s, e - s) for s, e in zip(starts, ends)]
+
+def carduid(c):
+    """ uid of a card, or full name if it has no uid """
+    if 'uid' in c.contents:
+        return c.uid.value
+    else:
+        return c.fn.value
+
+def cardrev(c):
+    """ revision time of a card, or None """
+    if 'rev' in c.contents:
+        return c.rev.value
+    return None
+
+def parsecard((raw, encoding)):
+    """ (uid, revision time, vcard) of a card's bytes, for a pool process """
+    c = vobject.readOne(raw.decode(encoding))
+    return carduid(c), cardrev(c), c
+
+class CardIndex(DictMixin):
+    """ contacts in a vcard file as a dictionary of uid: vcard
+
+    each card's offset, length and md5 are kept in an index, which is saved
+    between runs. Cards whose bytes are in the index are only read and parsed
+    when they are used; if the file's mtime and size match the index it is
+    not read at all. When many cards are new, they are parsed by a pool of
+    processes.
+    """
+    def __init__(self, filename, encoding, index=None, processes=1):
+        self.filename = filename
+        self.encoding = encoding
+        self.processes = processes
+        # uid: (offset, length, md5, rev) of cards unchanged from the file
+        self._cards = {}
+        # uid: vcard of cards that have been parsed or set
+        self._parsed = {}
+        # whether the file needs to be written even if no card has changed
+        self._dirty = False
+        self.parsed = 0
+        self._load(index or {})
+
+    def _load(self, index):
+        st = os.stat(self.filename)
+        self._stat = (st.st_mtime, st.st_size)
+        if index.get('stat') == self._stat:
+            # file untouched since index was made
+            self._cards = dict(index['cards'])
+            return
+        # look up cards by hash, parse those not seen before
+        known = dict([(card[2], (uid, card[3]))
+                for uid, card in index.get('cards', {}).items()])
+        contactsfile = open(self.filename, 'rb')
+        data = contactsfile.read()
+        contactsfile.close()
+        cards = [(offset, length, hashlib.md5(data[offset:offset + length])
+                .hexdigest()) for offset, length in splitcards(data)]
+        new = self._scan([data[offset:offset + length]
+                for offset, length, digest in cards if digest not in known])
+        new.reverse()
+        # in file order, so the last of cards with the same uid is kept
+        for offset, length, digest in cards:
+            if digest in known:
+                uid, rev = known[digest]
+                c = None
+            else:
+                uid, rev, c = new.pop()
+            if c is not None:
+                self._parsed[uid] = c
+            else:
+                # an earlier card with this uid may have been parsed
+                self._parsed.pop(uid, None)
+            self._cards[uid] = (offset, length, digest, rev)
+        if len(self._cards) != len(cards):
+            # duplicate uids
+            self._dirty = True
+
+    def _scan(self, raws):
+        """ (uid, rev, vcard) of cards not in the index
+        many are parsed in a pool of processes, which send the cards back
+        pickled """
+        if self.processes > 1 and len(raws) >= _poolthreshold:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                new = pool.map(parsecard, [(raw, self.encoding)
+                        for raw in raws], max(1, len(raws) //
+                        (self.processes * 4)))
+            finally:
+                pool.close()
+                pool.join()
+            self.parsed += len(raws)
+            return new
+        new = []
+        for raw in raws:
+            c = self._parse(raw)
+            new.append((carduid(c), cardrev(c), c))
+        return new
+
+    def _parse(self, raw):
+        self.parsed += 1
+        return vobject.readOne(raw.decode(self.encoding))
+
+    def _read(self, uid):
+        """ read a card's bytes from the file """
+        offset, length = self._cards[uid][:2]
+        contactsfile = open(self.filename, 'rb')
+        contactsfile.seek(offset)
+        raw = contactsfile.read(length)
+        contactsfile.close()
+        return raw
+
+    def __getitem__(self, uid):
+        if uid not in self._parsed:
+            if uid not in self._cards:
+                raise KeyError(uid)
+            self._parsed[uid] = self._parse(self._read(uid))
+        return self._parsed[uid]
+
+    def __setitem__(self, uid, c):
+        if self._parsed.get(uid) is not c:
+            # no longer the card in the file
+            self._cards.pop(uid, None)
+            self._parsed[uid] = c
+            self._dirty = True
+
+    def __delitem__(self, uid):
+        if uid not in self:
+            raise KeyError(uid)
+        self._cards.pop(uid, None)
+        self._parsed.pop(uid, None)
+        self._dirty = True
+
+    def __contains__(self, uid):
+        return uid in self._cards or uid in self._parsed
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def keys(self):
+        return list(set(self._cards) | set(self._parsed))
+
+    def rev(self, uid):
+        """ revision time of a card, without parsing it if possible """
+        if uid in self._cards:
+            return self._cards[uid][3]
+        return cardrev(self[uid])
+
+    def digest(self, uid):
+        """ md5 of a card's bytes in the file, or None if it has been set
+        since the file was read """
+        if uid in self._cards:
+            return self._cards[uid][2]
+        return None
+
+    def index(self):
+        """ index to pass to the next CardIndex for this file """
+        return {'stat': self._stat, 'cards': dict(self._cards)}
+
+    def changed(self):
+        """ whether the file would be changed by write() """
+        uids = sorted(self.keys())
+        return self._dirty or len(uids) != len(self._cards) or \
+                uids != sorted(uids, key=lambda uid: self._cards[uid][0])
+
+    def write(self):
+        """ write all cards to the file, sorted by uid so diffs are easier
+        unchanged cards are copied from the old file, and the new file is
+        renamed over it when complete
+        return False if nothing had changed and the file was not written """
+        if not self.changed():
+            return False
+        contactsfile = open(self.filename, 'rb')
+        temp, tempname = fileutil.tempfor(self.filename)
+        try:
+            cards = {}
+            offset = 0
+            for uid in sorted(self.keys()):
+                if uid in self._cards:
+                    oldoffset, length, digest, rev = self._cards[uid]
+                    contactsfile.seek(oldoffset)
+                    raw = contactsfile.read(length)
+                    if not raw.endswith('\n'):
+                        # was the last card in the file
+                        raw += '\r\n'
+                        digest = hashlib.md5(raw).hexdigest()
+                else:
+                    c = self._parsed[uid]
+                    raw = c.serialize().decode(self.encoding).encode(
+                            self.encoding)
+                    digest, rev = hashlib.md5(raw).hexdigest(), cardrev(c)
+                temp.write(raw)
+                cards[uid] = (offset, len(raw), digest, rev)
+                offset += len(raw)
+            temp.close()
+            fileutil.replace(tempname, self.filename)
+        except:
+            temp.close()
+            os.remove(tempname)
+            raise
+        finally:
+            contactsfile.close()
+        self._dirty = False
+        st = os.stat(self.filename)
+        self._stat = (st.st_mtime, st.st_size)
+        self._cards = cards
+        return True
@@ -5,6 +5,7 @@
 import xml.etree.cElementTree as ET
 import vobject, codecs, locale
 import sys, os.path
+from textnorm import stripAndJoin
 from optparse import OptionParser
 
 __version__ = '0.1alpha'
@@ -53,294 +54,308 @@ phoneRelTypes = {
 #       'OTHER': 'http://schemas.google.com/g/2005#other',
 
 def execute():
-    usage = 'usage: %prog [input file] | xmllint --format - > out.xml'
+    usage = 'usage: %prog [options] [input file] | xmllint --format - > out.xml'
     parser = OptionParser(usage=usage, version='%prog ' + __version__)
+    parser.add_option('-b', '--batch', dest='batchsize', type='int',
+            help='write gdata batch documents of N entries (at most 100)',
+            metavar='N', default=None)
+    parser.add_option('-o', '--output', dest='prefix', help='write batch ' +
+            'documents to PREFIX-0001.xml, PREFIX-0002.xml... instead of ' +
+            'one after another to stdout', metavar='PREFIX', default=None)
+    parser.add_option('-p', '--operation', dest='operation',
+            help='batch operation: insert, update or delete [%default]',
+            default='insert')
     (options, args) = parser.parse_args()
 
-    # open vcard file
-    try:
-        vcardfile = codecs.open(args[0], 'r', _encoding)
-    except IOError, msg:
-        print >>sys.stderr, msg
-        return 2
-    vcard = vcardfile.read()
+    # open vcard file, or read stdin
+    if args:
+        try:
+            vcardfile = codecs.open(args[0], 'r', _encoding)
+        except IOError, msg:
+            print >>sys.stderr, msg
+            return 2
+    else:
+        vcardfile = codecs.getreader(_encoding)(sys.stdin)
+    # cards are read, converted and written out a batch at a time
+    if options.batchsize:
+        writeBatches(iterVcards(vcardfile), options.batchsize,
+                options.operation, options.prefix)
+    else:
+        # TODO: this is almost useless since Google won't accept a feed of
+        # entries, use -b to write batch documents.
+        # http://code.google.com/apis/gdata/docs/batch.html
+        feed = batchFeed()
+        for vc in iterVcards(vcardfile):
+            feed.append(toXml(vc))
+        print ET.tostring(feed, encoding=_encoding)
     vcardfile.close()
-    # TODO: this is almost useless since Google won't accept a feed of entries.
-    # Should perhaps adapt this to output a batch document.
-    # http://code.google.com/apis/gdata/docs/batch.html
-    feed = ET.Element(addNS('feed', 'atom'))
-    for i, vc in enumerate(vobject.readComponents(vcard)):
-        xml = toXml(vc)
-        feed.insert(i, xml)
-    print ET.tostring(feed, encoding=_encoding)
+
+def iterVcards(vcardfile):
+    """ read vcards from a file one at a time, so that only one card's
+    lines are held in memory """
+    lines = []
+    for line in vcardfile:
+        if line[:11].upper() == u'BEGIN:VCARD' and lines:
+            yield vobject.readOne(u''.join(lines))
+            lines = []
+        lines.append(line)
+    if u''.join(lines).strip():
+        yield vobject.readOne(u''.join(lines))
+
+def writeBatches(vcards, batchsize, operation='insert', prefix=None):
+    """ write vcards as gdata batch documents of batchsize entries
+    each document goes to a file PREFIX-0001.xml etc. if prefix is given,
+    else to stdout followed by a blank line
+    batch ids are the cards' uids, or their position in the input """
+    feed, count, documents = batchFeed(), 0, 0
+    def write(feed, documents):
+        xml = ET.tostring(feed, encoding=_encoding)
+        if prefix is None:
+            sys.stdout.write(xml + '\n\n')
+            return
+        batchfile = open('{0}-{1:04d}.xml'.format(prefix, documents), 'wb')
+        batchfile.write(xml)
+        batchfile.close()
+    for i, vc in enumerate(vcards):
+        if 'uid' in vc.contents:
+            batchid = vc.uid.value
+        else:
+            batchid = str(i + 1)
+        addBatch(feed, toXml(vc), operation, batchid)
+        count += 1
+        if count == batchsize:
+            documents += 1
+            write(feed, documents)
+            feed, count = batchFeed(), 0
+    if count:
+        documents += 1
+        write(feed, documents)
+    return documents
 
 def addNS(tag, namespace):
     """ add a namespace from the namespace dictionary to a tag """
     return '{{{0}}}{1}'.format(namespaces[namespace], tag)
 
-def stripAndJoin(string, removeNewLines=True):
-    """ remove \n, \r, double spaces from string """
-    if removeNewLines:
-        string = string.replace('\n', '').replace('\r', '')
-    while '  ' in string:
-        string = string.replace('  ', ' ').strip()
-    return string
+# qualified tag names, made once rather than for every element
+_atom = dict([(tag, addNS(tag, 'atom')) for tag in ('entry', 'feed',
+        'category', 'id', 'updated', 'content')])
+_gd = dict([(tag, addNS(tag, 'gd')) for tag in ('etag', 'name',
+        'namePrefix', 'givenName', 'additionalName', 'familyName',
+        'nameSuffix', 'fullName', 'organization', 'orgName',
+        'orgDepartment', 'orgJobDescription', 'orgTitle', 'email',
+        'phoneNumber', 'structuredPostalAddress', 'pobox', 'housename',
+        'street', 'city', 'region', 'postcode', 'country',
+        'formattedAddress')])
+_gcontact = dict([(tag, addNS(tag, 'gcontact')) for tag in (
+        'groupMembershipInfo',)])
+_batch = dict([(tag, addNS(tag, 'batch')) for tag in ('operation', 'id')])
+# vobject Name and Address attributes: (tag, position in full name)
+_nameParts = {
+        u'prefix': (_gd['namePrefix'], 0),
+        u'given': (_gd['givenName'], 1),
+        u'additional': (_gd['additionalName'], 2),
+        u'family': (_gd['familyName'], 3),
+        u'suffix': (_gd['nameSuffix'], 4) }
+_addressParts = {
+        u'box': (_gd['pobox'], 0),
+        u'extended': (_gd['housename'], 1),
+        u'street': (_gd['street'], 2),
+        u'city': (_gd['city'], 3),
+        u'region': (_gd['region'], 4),
+        u'code': (_gd['postcode'], 5),
+        u'country': (_gd['country'], 6) }
+
+def batchFeed():
+    """ make an empty feed for a gdata batch request """
+    return ET.Element(_atom['feed'])
+
+def addBatch(feed, entry, operation, batchid):
+    """ add an entry to a batch feed
+    operation is one of insert, update, delete, query """
+    ET.SubElement(entry, _batch['operation'], type=operation)
+    bid = ET.SubElement(entry, _batch['id'])
+    bid.text = batchid
+    feed.append(entry)
+
+class Entry():
+    """ an entry being converted, and its organization element once made,
+    which ORG, ROLE and TITLE all add to """
+    def __init__(self):
+        self.xml = ET.Element(_atom['entry'])
+        self.organization = None
+
+    def getOrganization(self):
+        if self.organization is None:
+            self.organization = ET.SubElement(self.xml, _gd['organization'])
+        return self.organization
 
 def toXml(vcard):
     """ convert a vcard to xml format """
-    xml = ET.Element(addNS('entry', 'atom'))
+    entry = Entry()
     # add google category element
-    cat = ET.SubElement(xml, addNS('category', 'atom'),
+    cat = ET.SubElement(entry.xml, _atom['category'],
             scheme='http://schemas.google.com/g/2005#kind',
             term='http://schemas.google.com/contact/2008#contact')
 
     # convert each item from vcard
     for component in vcard.getChildren():
-        if component.name == u'X-GOOGLE-ETAG':
-            addEtag(xml, component)
-        if component.name == u'UID':
-            addId(xml, component)
-        elif component.name == u'REV':
-            addUpdated(xml, component)
-        elif component.name == u'N':
-            addName(xml, component)
-        elif component.name == u'ORG':
-            addOrganization(xml, component)
-        elif component.name == u'ROLE':
-            addJobDescription(xml, component)
-        elif component.name == u'TITLE':
-            addOrgTitle(xml, component)
-        elif component.name == u'NOTE':
-            addContent(xml, component)
-        elif component.name == u'EMAIL':
-            addEmail(xml, component)
-        elif component.name == u'TEL':
-            addPhoneNumber(xml, component)
-        elif component.name == u'ADR':
-            addAddress(xml, component)
-        elif component.name == u'X-GOOGLE-GROUP':
-            addGroup(xml, component)
-
-    return xml
-
-def addEtag(xml, component):
+        handler = handlers.get(component.name)
+        if handler is not None:
+            handler(entry, component)
+
+    return entry.xml
+
+def typeList(component):
+    """ a component's TYPE parameters, or None """
+    try:
+        return component.type_paramlist
+    except AttributeError:
+        return None
+
+def setRelOrLabel(element, types, relTypes, default=None, ignore=()):
+    """ set primary and one rel or label attribute from vcard types
+    google needs exactly one rel or label, default is the rel to use if the
+    types give neither """
+    relorlabel = None
+    for t in types or ():
+        if t == u'PREF':
+            element.set('primary', 'true')
+        elif t in ignore:
+            continue
+        elif t in relTypes and relorlabel is None:
+            element.set('rel', relTypes[t])
+            relorlabel = 'rel'
+        elif relorlabel is None:
+            element.set('label', t.capitalize())
+            relorlabel = 'label'
+    if relorlabel is None and default is not None:
+        element.set('rel', default)
+
+def addEtag(entry, component):
     etag = '"{0}."'.format(component.value)
-    xml.set(addNS('etag', 'gd'), etag)
+    entry.xml.set(_gd['etag'], etag)
 
-def addId(xml, component):
+def addId(entry, component):
     # actual id has url at start
-    id = ET.SubElement(xml, addNS('id', 'atom'))
+    id = ET.SubElement(entry.xml, _atom['id'])
     id.text = idbase + component.value
 
-def addGroup(xml, component):
-    group = ET.SubElement(xml, addNS('groupMembershipInfo', 'gcontact'))
+def addGroup(entry, component):
+    group = ET.SubElement(entry.xml, _gcontact['groupMembershipInfo'])
     group.set('deleted', 'false')
     group.set('href', grbase + component.value)
 
-def addUpdated(xml, component):
-    updated = ET.SubElement(xml, addNS('updated', 'atom'))
+def addUpdated(entry, component):
+    updated = ET.SubElement(entry.xml, _atom['updated'])
     updated.text = component.value
 
-def addName(xml, component):
-    name = ET.SubElement(xml, addNS('name', 'gd'))
+def addName(entry, component):
+    name = ET.SubElement(entry.xml, _gd['name'])
     fullname = ['', '', '', '', '']
     for t, v in component.value.__dict__.items():
-        if v == '':
+        if v == '' or t not in _nameParts:
             continue
-        if t == u'prefix':
-            n = ET.SubElement(name, addNS('namePrefix', 'gd'))
-            n.text = v
-            fullname[0] = v
-        elif t == u'given':
-            n = ET.SubElement(name, addNS('givenName', 'gd'))
-            n.text = v
-            fullname[1] = v
-        elif t == u'additional':
-            n = ET.SubElement(name, addNS('additionalName', 'gd'))
-            n.text = v
-            fullname[2] = v
-        elif t == u'family':
-            n = ET.SubElement(name, addNS('familyName', 'gd'))
-            n.text = v
-            fullname[3] = v
-        elif t == u'suffix':
-            n = ET.SubElement(name, addNS('nameSuffix', 'gd'))
-            n.text = v
-            fullname[4] = v
+        tag, i = _nameParts[t]
+        n = ET.SubElement(name, tag)
+        n.text = v
+        fullname[i] = v
     # add full name
-    n = ET.SubElement(name, addNS('fullName', 'gd'))
+    n = ET.SubElement(name, _gd['fullName'])
     n.text = stripAndJoin(' '.join(fullname))
 
-def addOrganization(xml, component):
-    # check if there is already an organization element
-    # (may have been added by ROLE or TITLE)
-    organization = xml.find(addNS('organization', 'gd'))
-    if not organization:
-        organization = ET.SubElement(xml, addNS('organization', 'gd'))
-    # deal with types
-    relorlabel = None
-    try:
-        for t in component.type_paramlist:
-            if t == u'PREF':
-                organization.set('primary', 'true')
-            elif t in orgRelTypes and relorlabel is None:
-                organization.set('rel', orgRelTypes[t])
-                relorlabel = 'rel'
-            elif relorlabel is None:
-                organization.set('label', t.capitalize())
-                relorlabel = 'label'
-    except AttributeError:
-        pass
-    if relorlabel is None:
-        # organization must have exactly one rel or label
-        organization.set('rel', orgRelTypes['WORK'])
+def addOrganization(entry, component):
+    # there may already be an organization element added by ROLE or TITLE
+    organization = entry.getOrganization()
+    setRelOrLabel(organization, typeList(component), orgRelTypes,
+            orgRelTypes['WORK'])
     # value
-    orgname = ET.SubElement(organization, addNS('orgName', 'gd'))
+    orgname = ET.SubElement(organization, _gd['orgName'])
     orgname.text = component.value[0]
     if len(component.value) > 1:
-        orgdepartment = ET.SubElement(organization, addNS('orgDepartment', 'gd'))
+        orgdepartment = ET.SubElement(organization, _gd['orgDepartment'])
         orgdepartment.text = component.value[1]
 
-def addJobDescription(xml, component):
-    # check if there is already an organization element
-    # (may have been added by ORG or TITLE)
-    organization = xml.find(addNS('organization', 'gd'))
-    if not organization:
-        organization = ET.SubElement(xml, addNS('organization', 'gd'))
-    jd = ET.SubElement(organization, addNS('orgJobDescription', 'gd'))
-    jd.text = component.value
+def addOrgDetail(entry, component, tag):
+    # there may already be an organization element added by ORG, ROLE or
+    # TITLE
+    organization = entry.getOrganization()
+    detail = ET.SubElement(organization, tag)
+    detail.text = component.value
     if organization.get('rel') is None and organization.get('label') is None:
         # organization must have exactly one rel or label
         organization.set('rel', orgRelTypes['WORK'])
 
-def addOrgTitle(xml, component):
-    # check if there is already an organization element
-    # (may have been added by ORG or ROLE)
-    organization = xml.find(addNS('organization', 'gd'))
-    if not organization:
-        organization = ET.SubElement(xml, addNS('organization', 'gd'))
-    tit = ET.SubElement(organization, addNS('orgTitle', 'gd'))
-    tit.text = component.value
-    if organization.get('rel') is None and organization.get('label') is None:
-        # organization must have exactly one rel or label
-        organization.set('rel', orgRelTypes['WORK'])
+def addJobDescription(entry, component):
+    addOrgDetail(entry, component, _gd['orgJobDescription'])
 
-def addContent(xml, component):
-    note = ET.SubElement(xml, addNS('content', 'atom'), type='text')
+def addOrgTitle(entry, component):
+    addOrgDetail(entry, component, _gd['orgTitle'])
+
+def addContent(entry, component):
+    note = ET.SubElement(entry.xml, _atom['content'], type='text')
     note.text = stripAndJoin(component.value)
 
-def addEmail(xml, component):
-    email = ET.SubElement(xml, addNS('email', 'gd'))
+def addEmail(entry, component):
+    email = ET.SubElement(entry.xml, _gd['email'])
     email.set('address', component.value)
-    # deal with types
-    relorlabel = None
-    try:
-        for t in component.type_paramlist:
-            if t == u'PREF':
-                email.set('primary', 'true')
-            elif t == u'INTERNET':
-                continue
-            elif t in emailRelTypes and relorlabel is None:
-                email.set('rel', emailRelTypes[t])
-                relorlabel = 'rel'
-            elif relorlabel is None:
-                email.set('label', t.capitalize())
-                relorlabel = 'label'
-    except AttributeError:
-        pass
-    if relorlabel is None:
-        # email must have exactly one rel or label
-        email.set('rel', emailRelTypes['HOME'])
+    setRelOrLabel(email, typeList(component), emailRelTypes,
+            emailRelTypes['HOME'], ignore=(u'INTERNET',))
 
-def addPhoneNumber(xml, component):
-    phone = ET.SubElement(xml, addNS('phoneNumber', 'gd'))
+def addPhoneNumber(entry, component):
+    phone = ET.SubElement(entry.xml, _gd['phoneNumber'])
     phone.text = component.value
-    # deal with types
-    try:
-        types = component.type_paramlist
-    except AttributeError:
-        types = None
-    relorlabel = None
+    # deal with types, without changing the vcard's
+    types = typeList(component)
     if types:
+        types = list(types)
         # pairs first
         for a, b in phoneRelTypesPairs.keys():
-            if a in types and b in types and relorlabel is None:
+            if a in types and b in types:
                 phone.set('rel', phoneRelTypesPairs[(a, b)])
-                del types[types.index(a)]
-                del types[types.index(b)]
-                relorlabel = 'rel'
-        # remaining types
-        for t in types:
-            if t == u'PREF':
-                phone.set('primary', 'true')
-            elif t in phoneRelTypes and relorlabel is None:
-                phone.set('rel', phoneRelTypes[t])
-                relorlabel = 'rel'
-            elif relorlabel is None:
-                phone.set('label', t.capitalize())
-                relorlabel = 'label'
+                types.remove(a)
+                types.remove(b)
+                # the pair is the rel, only PREF is left to set
+                types = [t for t in types if t == u'PREF']
+                break
+        setRelOrLabel(phone, types, phoneRelTypes)
     else:
         # phonenumber must have exactly one rel or label
         phone.set('rel', phoneRelTypes['HOME'])
 
-def addAddress(xml, component):
+def addAddress(entry, component):
     # check if empty
     if component.value.__str__().strip('\n ,') == '':
         return
-    address = ET.SubElement(xml, addNS('structuredPostalAddress', 'gd'))
-    # deal with types
-    relorlabel = None
-    try:
-        for t in component.type_paramlist:
-            if t == u'PREF':
-                address.set('primary', 'true')
-            elif t in addressRelTypes and relorlabel is None:
-                address.set('rel', addressRelTypes[t])
-                relorlabel = 'rel'
-            elif relorlabel is None:
-                address.set('label', t.capitalize())
-                relorlabel = 'label'
-    except AttributeError:
-        pass
-    if relorlabel is None:
-        # address mus have exactly one rel or label
-        address.set('rel', addressRelTypes['HOME'])
+    address = ET.SubElement(entry.xml, _gd['structuredPostalAddress'])
+    setRelOrLabel(address, typeList(component), addressRelTypes,
+            addressRelTypes['HOME'])
     # values
     fulladdress = [''] * 7
     for t, v in component.value.__dict__.items():
-        if v == '':
+        if v == '' or t not in _addressParts:
             continue
-        if t == u'box':
-            a = ET.SubElement(address, addNS('pobox', 'gd'))
-            a.text = v
-            fulladdress[0] = v
-        elif t == u'extended':
-            a = ET.SubElement(address, addNS('housename', 'gd'))
-            a.text = v
-            fulladdress[1] = v
-        elif t == u'street':
-            a = ET.SubElement(address, addNS('street', 'gd'))
-            a.text = v
-            fulladdress[2] = v
-        elif t == u'city':
-            a = ET.SubElement(address, addNS('city', 'gd'))
-            a.text = v
-            fulladdress[3] = v
-        elif t == u'region':
-            a = ET.SubElement(address, addNS('region', 'gd'))
-            a.text = v
-            fulladdress[4] = v
-        elif t == u'code':
-            a = ET.SubElement(address, addNS('postcode', 'gd'))
-            a.text = v
-            fulladdress[5] = v
-        elif t == u'country':
-            a = ET.SubElement(address, addNS('country', 'gd'))
-            a.text = v
-            fulladdress[6] = v
+        tag, i = _addressParts[t]
+        a = ET.SubElement(address, tag)
+        a.text = v
+        fulladdress[i] = v
     # add formatted address
-    a = ET.SubElement(address, addNS('formattedAddress', 'gd'))
+    a = ET.SubElement(address, _gd['formattedAddress'])
     a.text = stripAndJoin(' '.join(fulladdress))
 
+# vcard property: function adding it to an Entry
+handlers = {
+        u'X-GOOGLE-ETAG': addEtag,
+        u'UID': addId,
+        u'REV': addUpdated,
+        u'N': addName,
+        u'ORG': addOrganization,
+        u'ROLE': addJobDescription,
+        u'TITLE': addOrgTitle,
+        u'NOTE': addContent,
+        u'EMAIL': addEmail,
+        u'TEL': addPhoneNumber,
+        u'ADR': addAddress,
+        u'X-GOOGLE-GROUP': addGroup }
+
 if __name__ == '__main__':
     sys.exit(execute())
@@ -3,18 +3,24 @@
 """Convert xml from google contacts api to vcard"""
 
 import xml.etree.cElementTree as ET
-import vobject, codecs, locale
-import sys, os.path
+import vobject, locale
+import sys, os.path, hashlib
+import fileutil, textnorm
+from textnorm import unEntity
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
 __version__ = '0.1alpha'
 _encoding = locale.getpreferredencoding()
+batchNS = '{http://schemas.google.com/gdata/batch'
 
 def execute():
     usage = 'usage: %prog [options] [input file]'
     parser = OptionParser(usage=usage, version='%prog ' + __version__)
     parser.add_option('-d', '--dir', dest='directory', help='output to DIR',
             metavar='DIR', default=None)
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=4,
+            help='files written to DIR at the same time [%default]')
     (options, args) = parser.parse_args()
 
     if options.directory and not os.path.isdir(options.directory):
@@ -24,27 +30,63 @@ def execute():
         except:
             return 2
 
-    # open xml file
-    vcards = readXml(args[0], file=True)
+    # open xml file, contacts are parsed as they are written out
+    try:
+        xmlfile = open(args[0], 'rb')
+    except IOError, msg:
+        print >>sys.stderr, msg
+        return 2
+    vcards = iterXml(xmlfile)
 
     # output vcards
-    for v in vcards:
-        if options.directory:
-            # make filename from uid or full name
-            if 'uid' in v.contents:
-                filename = '{0}/{1}.vcf'.format(options.directory, v.uid.value)
-            else:
-                filename = '{0}/{1}.vcf'.format(options.directory,
-                        v.fn.value.replace(' ', '_'))
-                # TODO: encoding error here ^?
-            file = codecs.open(filename, 'w', _encoding)
-            file.write(v.serialize().decode(_encoding))
-            file.close()
-        else:
+    if options.directory:
+        # new files get the usual permissions rather than the temp file's
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0666 & ~umask
+        tasks = ((vcardFilename(options.directory, v), v, mode)
+                for v in vcards)
+        # cards are parsed here and serialized and written by the pool
+        pool = ThreadPool(options.jobs)
+        written, total = 0, 0
+        for w in pool.imap_unordered(exportVcard, tasks, 16):
+            written += w
+            total += 1
+        pool.close()
+        pool.join()
+        print >>sys.stderr, 'Wrote {0} of {1} contacts, the rest were ' \
+                'unchanged.'.format(written, total)
+    else:
+        for v in vcards:
             print v.serialize()
-
-def readXml(xml, file=False):
-    """ open the xml and find the contact entries """
+    xmlfile.close()
+
+def vcardFilename(directory, vcard):
+    """ make filename from uid or full name """
+    if 'uid' in vcard.contents:
+        return '{0}/{1}.vcf'.format(directory, vcard.uid.value)
+    # TODO: encoding error here?
+    return '{0}/{1}.vcf'.format(directory, vcard.fn.value.replace(' ', '_'))
+
+def exportVcard((filename, vcard, mode)):
+    """ write a vcard to filename, unless the file already holds the same
+    card; new files are made with mode
+    return True if the file was written """
+    data = vcard.serialize().decode(_encoding).encode(_encoding)
+    exists = os.path.exists(filename)
+    if exists and os.path.getsize(filename) == len(data):
+        vcardfile = open(filename, 'rb')
+        old = vcardfile.read()
+        vcardfile.close()
+        if hashlib.md5(old).digest() == hashlib.md5(data).digest():
+            return False
+    fileutil.atomicwrite(filename, data, None if exists else mode)
+    return True
+
+def readXml(xml, file=False, links=None):
+    """ open the xml and find the contact entries
+    if links is a dictionary, it is filled with the feed's links (rel: href)
+    """
     if file:
         try:
             xmlfile = ET.parse(xml)
@@ -70,8 +112,11 @@ def readXml(xml, file=False):
         <openSearch>
         """
         for element in xmlcard.getchildren():
-            if splitNS(element.tag)[1] == u'entry':
+            nn = splitNS(element.tag)[1]
+            if nn == u'entry':
                 vcards.append(parseEntry(element))
+            elif nn == u'link' and links is not None:
+                links[element.get('rel')] = element.get('href')
     elif splitNS(xmlcard.tag)[1] == u'entry':
         # this is a single contact
         vcards.append(parseEntry(xmlcard))
@@ -82,6 +127,61 @@ def readXml(xml, file=False):
 
     return vcards
 
+def iterXml(source, links=None):
+    """ parse xml from a file name or file object one contact at a time
+    yields vcards, each entry is discarded once it has been converted
+    if links is a dictionary, it is filled with the feed's links (rel: href)
+    """
+    depth = 0
+    root = None
+    for event, element in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+                isfeed = splitNS(root.tag)[1] == u'feed'
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            if not isfeed and splitNS(element.tag)[1] == u'entry':
+                # this is a single contact
+                yield parseEntry(element)
+        elif depth == 1 and isfeed:
+            nn = splitNS(element.tag)[1]
+            if nn == u'entry':
+                yield parseEntry(element)
+            elif nn == u'link' and links is not None:
+                links[element.get('rel')] = element.get('href')
+            # drop finished children of the feed
+            root.clear()
+
+def readBatch(xml):
+    """ read the response to a gdata batch request
+    return list of (batch id, operation, status code, reason, vcard)
+    vcard is None unless the operation returned a contact """
+    feed = ET.fromstring(xml.encode(_encoding))
+    results = []
+    for entry in feed.getchildren():
+        if splitNS(entry.tag)[1] != u'entry':
+            continue
+        batchid, operation, code, reason = None, None, None, None
+        for element in entry.getchildren():
+            ns, nn = splitNS(element.tag)
+            if ns != batchNS:
+                continue
+            if nn == u'id':
+                batchid = element.text
+            elif nn == u'operation':
+                operation = element.get('type')
+            elif nn == u'status':
+                code = int(element.get('code'))
+                reason = element.get('reason')
+        vcard = None
+        if code in (200, 201) and operation != u'delete':
+            vcard = parseEntry(entry)
+        results.append((batchid, operation, code, reason, vcard))
+    return results
+
 def splitNS(tag):
     """ split namespace from element names """
     if '}' in tag:
@@ -95,24 +195,10 @@ def gdRel(relstring):
     # TODO: CELL special case should be somewhere else...
     return relstring.partition('#')[2].replace('mobile', 'cell').upper()
 
-def unEntity(text):
-    """ remove incorrect xml entities """
-    while unichr(195) in text:
-        # get the character after
-        i = text.index(unichr(195))
-        newtext = text[:i] + unichr(ord(text[i+1]) + 64)
-        if len(text) >= i + 2:
-            newtext += text[i+2:]
-        text = newtext
-    return text
-
 def stripAndJoin(string, removeNewLines=True):
     """ remove \n, \r, double spaces from string """
-    if removeNewLines:
-        string = string.replace('\n', '').replace('\r', '')
-    while '  ' in string:
-        string = string.replace('  ', ' ').replace('\n ', '\n').strip()
-    return unEntity(string)
+    return unEntity(textnorm.stripAndJoin(string, removeNewLines,
+            newlineSpaces=True))
 
 def parseEntry(entry):
     """ parse an xml contact entry and return it as a vcard """
@@ -124,7 +210,10 @@ def parseEntry(entry):
             addEtag(vcard, v)
 
     for element in entry.getchildren():
-        nn = splitNS(element.tag)[1]
+        ns, nn = splitNS(element.tag)
+        if ns == batchNS:
+            # batch:id etc. are not contact details
+            continue
         """ knowingly ignoring these elements:
                 app:edited      seems to be the same as <updated>
                 category